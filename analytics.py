@@ -0,0 +1,173 @@
+"""
+Аналитические запросы к game_data.db.
+
+Каждый запрос опирается на индекс из init_db(), поэтому не просматривает
+player_actions целиком. check_query_plans() проверяет это по EXPLAIN
+QUERY PLAN: запуск с --check-plans завершается с ошибкой, если какой-то
+запрос перестал попадать в индекс.
+
+    python analytics.py --rounds
+    python analytics.py --lines --card "Дракон"
+    python analytics.py --timeline 12
+    python analytics.py --check-plans
+"""
+import argparse
+import re
+import sys
+
+import database
+
+
+# Сколько раз каждую карту выставляли в каждом раунде
+_CARD_PLAYS_BY_ROUND = """
+    SELECT round, card_name, COUNT(*) AS plays
+    FROM player_actions
+    WHERE action_type = 'place_card'
+    GROUP BY round, card_name
+    ORDER BY round, plays DESC
+"""
+
+_CARD_PLAYS_BY_ROUND_FOR_CARD = """
+    SELECT round, card_name, COUNT(*) AS plays
+    FROM player_actions
+    WHERE action_type = 'place_card' AND card_name = ?
+    GROUP BY round
+    ORDER BY round
+"""
+
+# Все действия сессии по порядку
+_SESSION_TIMELINE = """
+    SELECT id, timestamp, player, action_type, card_name, card_power, line_key, round
+    FROM player_actions
+    WHERE session_id = ?
+    ORDER BY id
+"""
+
+# На какие линии выставляют каждую карту
+_LINE_PLACEMENTS = """
+    SELECT card_name, line_key, COUNT(*) AS placements
+    FROM player_actions
+    WHERE action_type = 'place_card'
+    GROUP BY card_name, line_key
+"""
+
+_LINE_PLACEMENTS_FOR_CARD = """
+    SELECT card_name, line_key, COUNT(*) AS placements
+    FROM player_actions
+    WHERE action_type = 'place_card' AND card_name = ?
+    GROUP BY line_key
+"""
+
+_RECENT_SESSIONS = """
+    SELECT id, start_time, end_time, player1_name, player2_name, winner, duration_sec, rounds_played
+    FROM game_sessions
+    ORDER BY start_time DESC
+    LIMIT ?
+"""
+
+# Запросы и примеры параметров для проверки планов
+QUERIES = {
+    "card_plays_by_round": (_CARD_PLAYS_BY_ROUND, ()),
+    "card_plays_by_round_for_card": (_CARD_PLAYS_BY_ROUND_FOR_CARD, ("Дракон",)),
+    "session_timeline": (_SESSION_TIMELINE, (1,)),
+    "line_placements": (_LINE_PLACEMENTS, ()),
+    "line_placements_for_card": (_LINE_PLACEMENTS_FOR_CARD, ("Дракон",)),
+    "recent_sessions": (_RECENT_SESSIONS, (10,)),
+}
+
+# Полный просмотр таблицы без индекса: "SCAN player_actions" (новые
+# версии SQLite) или "SCAN TABLE player_actions" (старые)
+_FULL_SCAN = re.compile(r"\bSCAN (?:TABLE )?(\w+)(?! USING (?:COVERING )?INDEX)(?:\s|$)")
+
+
+def card_plays_by_round(card_name=None):
+    """Список (раунд, карта, розыгрышей); card_name - только одна карта"""
+    conn = database.get_connection()
+    if card_name is None:
+        return conn.execute(_CARD_PLAYS_BY_ROUND).fetchall()
+    return conn.execute(_CARD_PLAYS_BY_ROUND_FOR_CARD, (card_name,)).fetchall()
+
+
+def session_timeline(session_id):
+    """Действия сессии по порядку в виде словарей"""
+    conn = database.get_connection()
+    cur = conn.execute(_SESSION_TIMELINE, (session_id,))
+    columns = [column[0] for column in cur.description]
+    return [dict(zip(columns, row)) for row in cur]
+
+
+def line_placements(card_name=None):
+    """Распределение выставлений по линиям: {карта: {линия: количество}}"""
+    conn = database.get_connection()
+    if card_name is None:
+        rows = conn.execute(_LINE_PLACEMENTS)
+    else:
+        rows = conn.execute(_LINE_PLACEMENTS_FOR_CARD, (card_name,))
+    distribution = {}
+    for name, line_key, placements in rows:
+        distribution.setdefault(name, {})[line_key] = placements
+    return distribution
+
+
+def recent_sessions(limit=10):
+    conn = database.get_connection()
+    return conn.execute(_RECENT_SESSIONS, (limit,)).fetchall()
+
+
+def explain(sql, params=()):
+    """Строки EXPLAIN QUERY PLAN запроса"""
+    conn = database.get_connection()
+    return [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def check_query_plans():
+    """Возвращает [(запрос, строка плана)] для запросов, которые просматривают таблицу целиком"""
+    problems = []
+    for name, (sql, params) in QUERIES.items():
+        for detail in explain(sql, params):
+            if _FULL_SCAN.search(detail):
+                problems.append((name, detail))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Аналитика по game_data.db")
+    parser.add_argument("--db", help="путь к базе (по умолчанию game_data.db рядом с игрой)")
+    parser.add_argument("--card", help="ограничить отчёт одной картой")
+    parser.add_argument("--rounds", action="store_true", help="розыгрыши карт по раундам")
+    parser.add_argument("--lines", action="store_true", help="выставления карт по линиям")
+    parser.add_argument("--timeline", type=int, metavar="SESSION_ID", help="ход партии")
+    parser.add_argument("--sessions", type=int, nargs="?", const=10, metavar="N", help="последние партии")
+    parser.add_argument("--check-plans", action="store_true",
+                        help="проверить, что запросы используют индексы")
+    args = parser.parse_args()
+
+    if args.db:
+        database.DB_PATH = args.db
+    database.init_db()
+
+    if args.check_plans:
+        problems = check_query_plans()
+        for name, detail in problems:
+            print(f"[DB] {name}: {detail}")
+        print(f"[DB] Проверено запросов: {len(QUERIES)}, без индекса: {len(problems)}")
+        if problems:
+            sys.exit(1)
+    if args.rounds:
+        for round_num, card_name, plays in card_plays_by_round(args.card):
+            print(f"Раунд {round_num}  {card_name:<20} {plays}")
+    if args.lines:
+        for card_name, lines in sorted(line_placements(args.card).items()):
+            print(f"{card_name:<20} " + "  ".join(f"{line}: {count}" for line, count in sorted(lines.items())))
+    if args.timeline is not None:
+        for action in session_timeline(args.timeline):
+            print(f"#{action['id']} раунд {action['round']} {action['player']} {action['action_type']} "
+                  f"{action['card_name'] or ''} {action['card_power'] if action['card_power'] is not None else ''} "
+                  f"{action['line_key'] or ''}")
+    if args.sessions:
+        for row in recent_sessions(args.sessions):
+            print(" | ".join("" if value is None else str(value) for value in row))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,154 +1,133 @@
+import hashlib
 import os
 import pathlib
 
 class Card:
+    """
+    Прототип карты: неизменяемые свойства, общие для всех партий сервера
+    (имя, базовая сила, линии, способность, картинка). Изменчивое состояние
+    карты живёт отдельно - в рядах поля (BoardLine) или в CardInstance.
+    """
+    __slots__ = ("card_id", "name", "power", "image_path", "asset", "ability", "allowed_lines")
+
     def __init__(self, name, power, image_path, ability, allowed_lines):
-        self.name = name
-        self.power = power
-        self.image_path = image_path
-        self.ability = ability
-        self.allowed_lines = allowed_lines
+        init = object.__setattr__
+        init(self, "card_id", None)
+        init(self, "name", name)
+        init(self, "power", power)
+        init(self, "image_path", image_path)
+        init(self, "asset", os.path.basename(image_path))
+        init(self, "ability", ability)
+        init(self, "allowed_lines", tuple(allowed_lines))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Прототип карты неизменяем (атрибут {name})")
+
+    # Прототип один на сервер: копия - это он сам, а pickle сохраняет
+    # только id и восстанавливает ссылку на карту из cards_list
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return _card_by_id, (self.card_id,)
+
+
+class CardInstance:
+    """Экземпляр карты вне поля: ссылка на прототип, текущая сила и флаги"""
+    __slots__ = ("prototype", "power", "flags")
+
+    def __init__(self, prototype):
+        self.prototype = prototype
+        self.power = prototype.power
+        self.flags = CARD_FLAGS[prototype.card_id]
+
+    def __getattr__(self, name):
+        # Остальные свойства - общие, берутся из прототипа. Пока prototype
+        # не задан (copy и pickle создают объект без __init__), их нет;
+        # служебные методы (__deepcopy__ и т.п.) прототипа экземпляру не нужны
+        if name == "prototype" or name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.prototype, name)
 
 # Способности карт
-def oak_bard_lights_ability(line_cards, card, played_line):
+#
+# Способность получает поле (engine.Board), ключ ряда, куда сыграна карта,
+# и позицию карты в этом ряду. Ряд хранит параллельные массивы
+# card_ids / powers / flags, поэтому способности сравнивают целые id карт,
+# а не имена.
+
+def oak_bard_lights_ability(board, played_line, index):
     """Усиливает всех союзников в ряду на +1 (включая себя)"""
-    if played_line in line_cards:
-        enhanced_cards = []
-        
-        for other_card in line_cards[played_line]:
-            old_power = other_card.get("power", 0)
-            other_card["power"] = old_power + 1
-            enhanced_cards.append(f"{other_card.get('name', 'карта')}: {old_power}→{other_card['power']}")
-            print(f"[CARDS] Бард/Дуб/Огни усилил {other_card.get('name', 'карту')} с {old_power} до {other_card['power']}")
-        
-        if enhanced_cards:
-            print(f"[CARDS] Бард/Дуб/Огни усилил карты на линии {played_line}: {', '.join(enhanced_cards)}")
-        else:
-            print(f"[CARDS] Бард/Дуб/Огни: на линии {played_line} нет карт для усиления")
-    else:
-        print(f"[CARDS] Бард/Дуб/Огни: линия {played_line} не найдена")
-
-def frost_ability(line_cards, card, played_line):
+    line = board[played_line]
+    for i in range(len(line)):
+        line.add_power(i, 1)
+
+def frost_ability(board, played_line, index):
     """
     Ослабляет все карты противника в front-ряду на 1
     """
     enemy = "p2" if "p1" in played_line else "p1"
-    enemy_front_line = f"{enemy}_front"
-
-    if enemy_front_line in line_cards:
-        for c in line_cards[enemy_front_line]:
-            # Пропускаем разбойника
-            if c.get("name") == "Разбойник":
-                print(f"[CARDS] Мороз пропускает разбойника (иммунитет к ослаблению)")
-                continue
-                
-            if c.get("power", 0) > 0:
-                c["power"] -= 1
-                print(f"[CARDS] Мороз ослабил карту {c.get('name', '')} до {c['power']}")
-
-def fog_ability(line_cards, card, played_line):
+    line = board[f"{enemy}_front"]
+
+    for i, flags in enumerate(line.flags):
+        # Разбойник невосприимчив к ослаблению
+        if not flags & IMMUNE and line.powers[i] > 0:
+            line.add_power(i, -1)
+
+def fog_ability(board, played_line, index):
     """
     Ослабляет все карты противника в back-ряду на 1
     """
-    # определяем противника
     enemy = "p2" if "p1" in played_line else "p1"
-    enemy_back_line = f"{enemy}_back"
+    line = board[f"{enemy}_back"]
 
-    if enemy_back_line in line_cards:
-        for c in line_cards[enemy_back_line]:
-            # Используем c["power"] вместо c["data"].power
-            if c.get("power", 0) > 0:
-                c["power"] -= 1
-                print(f"[CARDS] Мгла ослабила карту {c.get('name', '')} до {c['power']}")
+    for i, power in enumerate(line.powers):
+        if power > 0:
+            line.add_power(i, -1)
 
-def engineer_ability(line_cards, card, played_line):
+def engineer_ability(board, played_line, index):
     """
     Усиливает самую слабую карту в ряду на +3
     """
-    cards_in_line = line_cards.get(played_line, [])
-
-    # исключаем самого инженера
-    targets = [c for c in cards_in_line if c is not card]
+    line = board[played_line]
 
-    if not targets:
-        print(f"[CARDS] Инженер: нет других карт в ряду для усиления")
-        return
+    # карта с минимальной силой, исключая самого инженера
+    weakest = line.weakest(exclude=index)
+    if weakest is not None:
+        line.add_power(weakest, 3)
 
-    # ищем карту с минимальной силой - используем c["power"] вместо c["data"].power
-    weakest = min(targets, key=lambda c: c.get("power", 0))
-    
-    old_power = weakest.get("power", 0)
-    weakest["power"] = old_power + 3
-    
-    print(f"[CARDS] Инженер усилил самую слабую карту '{weakest.get('name', 'карту')}' с {old_power} до {weakest['power']}")
-
-def mage_synergy_ability(line_cards, card, played_line):
+def mage_synergy_ability(board, played_line, index):
     """
     Если на столе есть и Огненный маг, и Ледяной маг —
     оба получают +2 (один раз)
     """
-    # Собираем все карты на поле (включая только что сыгранную)
-    all_cards = []
-    for cards in line_cards.values():
-        all_cards.extend(cards)
-    
-    fire_mage = None
-    ice_mage = None
-    
-    # Ищем магов среди всех карт на поле
-    for c in all_cards:
-        if c.get("name") == "Огненный маг":
-            fire_mage = c
-        elif c.get("name") == "Ледяной маг":
-            ice_mage = c
-    
-    # Если одного из магов нет — выходим
-    if not fire_mage or not ice_mage:
-        return
-    
-    # Проверяем, был ли уже бафф применен
-    # Создаем уникальные ключи для проверки
-    fire_mage_id = id(fire_mage)
-    ice_mage_id = id(ice_mage)
-    
-    # Используем флаг в самих объектах карт
-    if fire_mage.get("mage_buffed") or ice_mage.get("mage_buffed"):
-        return
-    
-    # Применяем бафф
-    fire_mage["power"] += 2
-    ice_mage["power"] += 2
-    
-    # Помечаем, что бафф применен
-    fire_mage["mage_buffed"] = True
-    ice_mage["mage_buffed"] = True
-    
-    # Выводим отладочную информацию
-    print(f"[CARDS] Активирована синергия магов: {fire_mage['name']} и {ice_mage['name']} получают +2")
-
-def dragon_ability(line_cards, card, played_line):
+    # Пара берётся прямо из индекса поля: позиции ещё не баффнутых магов
+    # каждого вида (последний выложенный - первым). Поле не просматривается
+    unbuffed = board.unbuffed
+    if not unbuffed[FIRE_MAGE_ID] or not unbuffed[ICE_MAGE_ID]:
+        return False
+
+    # Бафф применяется только один раз: set_flag убирает мага из индекса
+    pair = (tuple(unbuffed[FIRE_MAGE_ID][-1]), tuple(unbuffed[ICE_MAGE_ID][-1]))
+    for line, i in pair:
+        line.add_power(i, 2)
+        line.set_flag(i, MAGE_BUFFED)
+    return True
+
+def dragon_ability(board, played_line, index):
     """
     Дракон уничтожает самую сильную карту противника в ближнем ряду
     """
     enemy = "p2" if "p1" in played_line else "p1"
-    enemy_front_line = f"{enemy}_front"
-    
-    if enemy_front_line in line_cards and line_cards[enemy_front_line]:
-        # Исключаем разбойника из возможных целей уничтожения
-        eligible_cards = [c for c in line_cards[enemy_front_line] 
-                         if c.get("name") != "Разбойник"]
-        
-        if not eligible_cards:
-            print(f"[CARDS] Дракон не нашел подходящих целей")
-            return
-        
-        # Находим самую сильную карту среди оставшихся
-        strongest_card = max(eligible_cards, key=lambda c: c["power"])
-        
-        # Уничтожаем её
-        line_cards[enemy_front_line].remove(strongest_card)
-        
-        print(f"[CARDS] Дракон уничтожил {strongest_card['name']} ({strongest_card['power']} силы) на линии {enemy_front_line}")
+    line = board[f"{enemy}_front"]
+
+    # Разбойник не может быть целью уничтожения
+    strongest = line.strongest_target()
+    if strongest is not None:
+        line.remove(strongest)
 
 def get_asset_path(filename):
     import pathlib
@@ -369,21 +348,50 @@ cards_list = [
     ) #29
 ]
 
-import copy
+# Идентификатор карты - её индекс в cards_list (единственная запись в прототип)
+for card_id, card in enumerate(cards_list):
+    object.__setattr__(card, "card_id", card_id)
 
 # Создаем словарь для быстрого поиска карты по имени
 # Ключ - имя карты, Значение - объект карты из списка
 CARDS_DICT = {card.name: card for card in cards_list}
+CARD_IDS = {card.name: card.card_id for card in cards_list}
+
+BANDIT_ID = CARD_IDS["Разбойник"]
+FIRE_MAGE_ID = CARD_IDS["Огненный маг"]
+ICE_MAGE_ID = CARD_IDS["Ледяной маг"]
+
+# Флаги карты на поле (битовая маска в BoardLine.flags)
+MAGE_BUFFED = 1
+IMMUNE = 2      # не может быть ослаблена или уничтожена способностями противника
+
+# Флаги, с которыми карта выходит на поле (индекс - id карты)
+CARD_FLAGS = [IMMUNE if card.card_id == BANDIT_ID else 0 for card in cards_list]
+
+def _card_by_id(card_id):
+    """Прототип карты по id (восстановление из pickle)"""
+    return cards_list[card_id]
 
 def get_card_by_name(name):
     """
-    Возвращает глубокую копию карты по её имени.
+    Возвращает новый экземпляр карты по её имени.
     Если карта не найдена, возвращает None.
     """
     if name in CARDS_DICT:
-        # copy.deepcopy важен, чтобы изменения силы одной карты 
-        # не влияли на другую такую же карту в колоде
-        return copy.deepcopy(CARDS_DICT[name])
+        # Экземпляр хранит только свою силу и флаги, изменения силы одной
+        # карты не влияют на другую такую же карту в колоде
+        return CardInstance(CARDS_DICT[name])
     return None
 
+def get_card_id(name):
+    """Возвращает id карты по её имени или None, если такой карты нет"""
+    return CARD_IDS.get(name)
+
+def deck_hash(card_ids):
+    """
+    Адрес колоды в реестре: хеш отсортированных id карт. Порядок карт
+    не важен - колода всё равно перемешивается перед партией.
+    """
+    return hashlib.sha256(bytes(sorted(card_ids))).hexdigest()[:32]
+
 
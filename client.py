@@ -2,13 +2,13 @@ from os import environ
 environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
 import pygame
 import socket
-import json
 import threading
 import time
-import struct
 import os
 import sys
 from settings import get_saved_display_settings, scale_value, get_audio_settings
+from protocol import apply_delta, encode_frame, FrameReader, CODEC_BINARY
+from cards import get_card_id, deck_hash
 
 class GameClient:
     def __init__(self):
@@ -64,6 +64,7 @@ class GameClient:
         
         # Сокет
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.reader = FrameReader(self.client)
         
         # Игровые данные
         self.player_id = None
@@ -71,6 +72,13 @@ class GameClient:
         self.game_state = None
         self.line_cards = None
         self.hands = {"p1": [], "p2": []}
+        # Сервер присылает только свою руку, от руки соперника - число карт
+        self.hand_counts = {"p1": 0, "p2": 0}
+        # Версия состояния для применения дельт; None - ждём полный снимок
+        self.state_version = None
+        self.resync_requested = False
+        # Колода, отправленная хешем: на deck_unknown досылаем имена карт
+        self.offered_deck = None
         self.card_images = {}
         self.zoomed_card = None
         
@@ -242,6 +250,16 @@ class GameClient:
             self.music_playing = False
             print("[CLIENT] Музыка остановлена")
 
+    def send_ready(self, user_deck):
+        """Готовность: сначала только хеш колоды, список имён - если сервер попросит"""
+        card_ids = [get_card_id(name) if isinstance(name, str) else None for name in user_deck]
+        if None in card_ids:
+            # Незнакомые карты - пусть сервер сам объяснит, что не так
+            self.send_action("ready", {"deck_cards": user_deck})
+            return
+        self.offered_deck = (deck_hash(card_ids), user_deck)
+        self.send_action("ready", {"deck_hash": self.offered_deck[0]})
+
     def load_user_deck(self):
         import os
         import json
@@ -343,12 +361,8 @@ class GameClient:
     def send_message(self, message):
         """Отправка сообщения с указанием размера"""
         try:
-            
-            data = json.dumps(message).encode('utf-8')
-           
-            self.client.send(struct.pack('!I', len(data)))
-            
-            self.client.send(data)
+            # Заголовок и тело уходят одним кадром за один вызов
+            self.client.sendall(encode_frame(message))
             return True
         except Exception as e:
             print(f"[CLIENT] Ошибка отправки: {e}")
@@ -357,22 +371,7 @@ class GameClient:
     def receive_message(self):
         """Получение сообщения с указанием размера"""
         try:
-            
-            raw_msglen = self.client.recv(4)
-            if not raw_msglen:
-                return None
-            
-            msglen = struct.unpack('!I', raw_msglen)[0]
-            
-           
-            data = b''
-            while len(data) < msglen:
-                packet = self.client.recv(min(4096, msglen - len(data)))
-                if not packet:
-                    return None
-                data += packet
-            
-            return json.loads(data.decode('utf-8'))
+            return self.reader.read_message()
         except Exception as e:
             print(f"[CLIENT] Ошибка получения: {e}")
             return None
@@ -426,24 +425,45 @@ class GameClient:
             self.player_id = data["player_id"]
             self.player_name = data["player_name"]
             print(f"[CLIENT] Вы {self.player_name} (ID: {self.player_id})")
+
+            # Бинарный кодек, если сервер его поддерживает (GAMBIT_CODEC=json - для отладки)
+            codec = os.environ.get('GAMBIT_CODEC', CODEC_BINARY)
+            if codec in data.get("codecs", []):
+                self.send_action("hello", {"codec": codec})
             
+        elif msg_type == "deck_unknown":
+            # Сервер не знает колоду по хешу - отправляем полный список
+            if self.offered_deck is not None and data.get("deck_hash") == self.offered_deck[0]:
+                print("[CLIENT] Колода неизвестна серверу, отправляем список карт")
+                self.send_action("ready", {"deck_cards": self.offered_deck[1]})
+                self.offered_deck = None
+
         elif msg_type == "player_ready":
             print(f"[CLIENT] Игрок {data['player']} готов. Готовых: {data['ready_players']}/2")
             
         elif msg_type == "game_update":
             
-            old_turn = self.game_state["current_turn"] if self.game_state else None
+            old_turn = self.game_state.get("current_turn") if self.game_state else None
             self.game_state = data["game_state"]
-            new_turn = self.game_state["current_turn"]
-
-            if old_turn is not None and old_turn != new_turn and new_turn != self.player_id:
-                self.reset_drag_state()
-            
             self.line_cards = data["line_cards"]
-            self.hands = data["hands"]
-            self.game_started = self.game_state["game_started"]
+            self.hands = data.get("hands", {})
+            self.hand_counts = data.get("hand_counts", {})
+            self.state_version = data.get("version")
+            self.resync_requested = False
+            self.on_state_changed(old_turn)
+
+        elif msg_type == "game_delta":
+            if self.game_state is None or data["base"] != self.state_version:
+                # Пропустили обновление - просим полный снимок
+                if not self.resync_requested:
+                    self.resync_requested = True
+                    self.send_action("resync")
+                return
 
-            self.preload_card_images()
+            old_turn = self.game_state.get("current_turn")
+            apply_delta(self.game_state, self.line_cards, self.hands, self.hand_counts, data)
+            self.state_version = data["version"]
+            self.on_state_changed(old_turn)
             
         elif msg_type == "chat_message":
             message = f"""{data.get('player_name', f"Игрок {data['player']}")}: {data['message']}"""
@@ -454,6 +474,15 @@ class GameClient:
         elif msg_type == "player_disconnected":
             print(f"[CLIENT] Игрок {data['player']} отключился")
     
+    def on_state_changed(self, old_turn):
+        """Общая обработка нового состояния после снимка или дельты"""
+        new_turn = self.game_state["current_turn"]
+        if old_turn is not None and old_turn != new_turn and new_turn != self.player_id:
+            self.reset_drag_state()
+
+        self.game_started = self.game_state["game_started"]
+        self.preload_card_images()
+
     def reset_drag_state(self):
         """Сброс состояния перетаскивания"""
         self.selected_card_index = None
@@ -464,8 +493,8 @@ class GameClient:
     def preload_card_images(self):
         """Предзагрузка изображений карт"""
         all_cards = []
-        for player in ["p1", "p2"]:
-            all_cards.extend(self.hands.get(player, []))
+        for hand in self.hands.values():
+            all_cards.extend(hand)
         
         for key in self.line_cards:
             all_cards.extend(self.line_cards.get(key, []))
@@ -636,10 +665,8 @@ class GameClient:
             line_width = scale_value(5, 'x', self.SCALE_X, self.SCALE_Y) if hover_line == key else scale_value(2, 'x', self.SCALE_X, self.SCALE_Y)
             pygame.draw.rect(self.screen, color, line_rect, line_width)
             
-            # Сила линии
-            line_power = 0
-            for card in self.line_cards.get(key, []):
-                line_power += card.get("power", 0)
+            # Сила линии - сервер присылает готовые суммы рядов
+            line_power = self.game_state.get("line_power", {}).get(key, 0)
             
             power_text = self.FONT.render(str(line_power), True, self.WHITE)
             self.screen.blit(power_text, (scale_value(10, 'x', self.SCALE_X, self.SCALE_Y), 
@@ -777,8 +804,9 @@ class GameClient:
                                       self.pass_btn_rect.centery - btn_text.get_height()//2))
         
         # 5. Сообщения игры
+        # Сообщения стола снимает сервер; у локальных есть свой срок показа
         if (self.game_state.get("message") and 
-            self.game_state.get("message_timer", 0) > time.time()):
+            self.game_state.get("message_timer", float("inf")) > time.time()):
             
             text_surf = self.FONT.render(self.game_state["message"], True, (255, 255, 0))
             bg_rect = text_surf.get_rect(center=(self.selected_width // 2, 
@@ -991,7 +1019,7 @@ class GameClient:
                             
                             if user_deck:
                                 
-                                self.send_action("ready", {"deck_cards": user_deck})
+                                self.send_ready(user_deck)
                             else:
                                 print("[CLIENT] Ошибка: Не удалось загрузить колоду для отправки")
                                 self.game_state = {"message": "Ошибка: нет файла my_deck.json!", "message_timer": time.time() + 3}
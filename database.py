@@ -1,14 +1,62 @@
 import sqlite3
 import json
 import datetime
+import threading
+import queue
+import time
+import zlib
 
 import pathlib
 DB_PATH = str(pathlib.Path(__file__).parent / "game_data.db")
 
+# Соединения живут всё время работы сервера: по одному на поток и файл
+# базы (поток почтового ящика стола или поток цикла событий).
+# WAL позволяет читать базу во время записи, а synchronous=NORMAL в
+# режиме WAL не делает fsync на каждый commit - только при checkpoint.
+# Встроенный кэш подготовленных выражений sqlite3 (128 штук по умолчанию)
+# с долгоживущим соединением тоже не сбрасывается между вызовами.
+_local = threading.local()
+# Открытые соединения всех потоков: соединение -> путь к базе
+_connections = {}
+_connections_lock = threading.Lock()
 
-def init_db():
+
+def get_connection(path=None):
+    """Возвращает долгоживущее соединение текущего потока с базой path (по умолчанию DB_PATH)"""
+    path = path or DB_PATH
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(path)
+    # Соединение могли закрыть из другого потока через close_connections()
+    if conn is not None and conn in _connections:
+        return conn
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    connections[path] = conn
+    with _connections_lock:
+        _connections[conn] = path
+    return conn
+
+
+def close_connections(path=None):
+    """Закрывает соединения всех потоков с базой path или со всеми базами (при остановке сервера)"""
+    with _connections_lock:
+        connections = [conn for conn, conn_path in _connections.items()
+                       if path is None or conn_path == path]
+        for conn in connections:
+            del _connections[conn]
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            print(f"[DB] Ошибка закрытия соединения: {e}")
+
+
+def init_db(path=None):
     """Создаёт таблицы, если они ещё не существуют"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection(path)
     cur = conn.cursor()
 
     # Игровые сессии
@@ -21,7 +69,8 @@ def init_db():
         player2_name TEXT,
         winner TEXT,
         duration_sec INTEGER,
-        rounds_played INTEGER
+        rounds_played INTEGER,
+        winner_seat TEXT
     )
     """)
 
@@ -50,91 +99,412 @@ def init_db():
         times_used INTEGER DEFAULT 0,
         avg_power REAL DEFAULT 0,
         ability_activations INTEGER DEFAULT 0,
-        win_rate REAL DEFAULT 0
+        win_rate REAL DEFAULT 0,
+        power_sum INTEGER DEFAULT 0,
+        matches_played INTEGER DEFAULT 0,
+        wins INTEGER DEFAULT 0
     )
     """)
 
-    conn.commit()
-    conn.close()
-
+    # Индексы под запросы аналитики (analytics.py): действия сессии по
+    # порядку, розыгрыши карт по раундам и по линиям
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_actions_session ON player_actions (session_id)")
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_actions_round_card
+    ON player_actions (action_type, round, card_name)
+    """)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_actions_card_line
+    ON player_actions (action_type, card_name, line_key)
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sessions_start ON game_sessions (start_time)")
 
-def insert_game_session(start_time, p1, p2):
-    """Создаёт новую запись игровой сессии"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    # Реестр проверенных колод: хеш отсортированных id карт -> сами id
     cur.execute("""
-        INSERT INTO game_sessions (start_time, player1_name, player2_name)
-        VALUES (?, ?, ?)
-    """, (start_time, p1, p2))
-    conn.commit()
-    session_id = cur.lastrowid
-    conn.close()
-    return session_id
+    CREATE TABLE IF NOT EXISTS decks (
+        deck_hash TEXT PRIMARY KEY,
+        card_ids BLOB,
+        created DATETIME
+    )
+    """)
 
+    # Место победителя (p1/p2, NULL - ничья): в старых базах восстанавливаем
+    # его по именам игроков, тогда они ещё совпадали с меткой победителя
+    columns = {row[1] for row in cur.execute("PRAGMA table_info(game_sessions)")}
+    if "winner_seat" not in columns:
+        cur.execute("ALTER TABLE game_sessions ADD COLUMN winner_seat TEXT")
+        cur.execute("""
+            UPDATE game_sessions SET winner_seat = CASE winner
+                WHEN player1_name THEN 'p1' WHEN player2_name THEN 'p2' END
+        """)
+
+    # Суммы для точных средних: в базах старого формата их ещё нет,
+    # восстанавливаем их из сохранённых средних, а победы - из логов
+    columns = {row[1] for row in cur.execute("PRAGMA table_info(card_statistics)")}
+    if "power_sum" not in columns:
+        cur.execute("ALTER TABLE card_statistics ADD COLUMN power_sum INTEGER DEFAULT 0")
+        cur.execute("UPDATE card_statistics SET power_sum = CAST(ROUND(avg_power * times_used) AS INTEGER)")
+    if "matches_played" not in columns:
+        cur.execute("ALTER TABLE card_statistics ADD COLUMN matches_played INTEGER DEFAULT 0")
+        if "wins" not in columns:
+            cur.execute("ALTER TABLE card_statistics ADD COLUMN wins INTEGER DEFAULT 0")
+        _recompute_win_rates(cur)
 
-def end_game_session(session_id, winner, rounds_played, duration_sec):
-    """Обновляет запись после завершения сессии"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        UPDATE game_sessions
-        SET end_time = ?, winner = ?, rounds_played = ?, duration_sec = ?
-        WHERE id = ?
-    """, (datetime.datetime.now(), winner, rounds_played, duration_sec, session_id))
     conn.commit()
-    conn.close()
 
 
-def log_action(session_id, player, action_type, card_name=None, card_power=None,
-               line_key=None, game_state=None, round_num=1):
-    """Сохраняет ход игрока"""
-    if session_id is None:
-        return
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO player_actions
-        (session_id, timestamp, player, action_type, card_name, card_power, line_key, result_state, round)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (session_id,
-          datetime.datetime.now(),
-          player,
-          action_type,
-          card_name,
-          card_power,
-          line_key,
-          json.dumps(game_state, ensure_ascii=False),
-          round_num))
-    conn.commit()
-    conn.close()
+def last_session_id(path=None):
+    """
+    Наибольший id сессии, выданный в базе (с учётом удалённых строк).
+    Сервер выдаёт id новых сессий сам, начиная со следующего, а строка
+    сессии пишется через очередь WriteBehind
+    """
+    conn = get_connection(path)
+    return conn.execute("""
+        SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'game_sessions'), 0),
+                   COALESCE((SELECT MAX(id) FROM game_sessions), 0))
+    """).fetchone()[0]
 
 
-def update_card_statistics(card_name, power, ability_used=False, win=False):
-    """Обновляет агрегированную статистику карт"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+_START_SESSION = """
+    INSERT INTO game_sessions (id, start_time, player1_name, player2_name)
+    VALUES (?, ?, ?, ?)
+"""
 
-    # Проверяем, есть ли карта
-    cur.execute("SELECT times_used, avg_power, ability_activations, win_rate FROM card_statistics WHERE card_name = ?", (card_name,))
-    row = cur.fetchone()
 
-    if row:
-        times_used, avg_power, ability_activations, win_rate = row
-        new_times = times_used + 1
-        new_avg = (avg_power * times_used + power) / new_times
-        new_ability = ability_activations + (1 if ability_used else 0)
-        new_winrate = (win_rate * times_used + (1 if win else 0)) / new_times
+def load_decks(path=None):
+    """Все известные колоды: {хеш: кортеж id карт}"""
+    conn = get_connection(path)
+    return {row[0]: tuple(row[1]) for row in conn.execute("SELECT deck_hash, card_ids FROM decks")}
 
-        cur.execute("""
-            UPDATE card_statistics
-            SET times_used=?, avg_power=?, ability_activations=?, win_rate=?
-            WHERE card_name=?
-        """, (new_times, new_avg, new_ability, new_winrate, card_name))
-    else:
-        cur.execute("""
-            INSERT INTO card_statistics (card_name, times_used, avg_power, ability_activations, win_rate)
-            VALUES (?, ?, ?, ?, ?)
-        """, (card_name, 1, power, 1 if ability_used else 0, 1 if win else 0))
 
-    conn.commit()
-    conn.close()
+def save_deck(deck_hash, card_ids, path=None):
+    """Добавляет колоду в реестр (повторная запись той же колоды ничего не меняет)"""
+    conn = get_connection(path)
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO decks (deck_hash, card_ids, created) VALUES (?, ?, ?)",
+                     (deck_hash, bytes(sorted(card_ids)), datetime.datetime.now()))
+
+
+_END_SESSION = """
+    UPDATE game_sessions
+    SET end_time = ?, winner = ?, winner_seat = ?, rounds_played = ?, duration_sec = ?
+    WHERE id = ?
+"""
+
+
+# result_state хранится компактно: каждое KEYFRAME_INTERVAL-е действие
+# сессии (и первое) - полный снимок, остальные - только изменившиеся с
+# предыдущего действия поля. Снимки, начинающиеся с "{", - это полные
+# состояния (так записаны и старые строки), "+" - разница, bytes - снимок,
+# сжатый zlib.
+KEYFRAME_INTERVAL = 32
+COMPRESS_KEYFRAMES = True
+_DELTA_PREFIX = "+"
+_REMOVED = "-"
+
+
+class StateEncoder:
+    """Помнит последнее состояние каждой сессии и кодирует следующее относительно него"""
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL, compress=COMPRESS_KEYFRAMES):
+        self.keyframe_interval = keyframe_interval
+        self.compress = compress
+        # session_id -> (поля последнего состояния в JSON, действий с последнего снимка)
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def encode(self, session_id, game_state):
+        if game_state is None:
+            return None
+        fields = {key: json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+                  for key, value in game_state.items()}
+        with self.lock:
+            previous, since_keyframe = self.sessions.get(session_id, (None, 0))
+            if previous is None or since_keyframe + 1 >= self.keyframe_interval:
+                self.sessions[session_id] = (fields, 0)
+                return self.keyframe(fields)
+            self.sessions[session_id] = (fields, since_keyframe + 1)
+        changed = [f'"{key}":{value}' for key, value in fields.items() if previous.get(key) != value]
+        removed = [key for key in previous if key not in fields]
+        if removed:
+            changed.append(f'"{_REMOVED}":{json.dumps(removed, ensure_ascii=False, separators=(",", ":"))}')
+        return _DELTA_PREFIX + "{" + ",".join(changed) + "}"
+
+    def keyframe(self, fields):
+        text = "{" + ",".join(f'{json.dumps(key)}:{value}' for key, value in fields.items()) + "}"
+        if self.compress:
+            return zlib.compress(text.encode('utf-8'))
+        return text
+
+    def forget(self, session_id):
+        """Сессия закончилась - её последнее состояние больше не нужно"""
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+
+def decode_state(stored, previous=None):
+    """Восстанавливает состояние по значению result_state и предыдущему состоянию"""
+    if stored is None:
+        return previous
+    if isinstance(stored, bytes):
+        stored = zlib.decompress(stored).decode('utf-8')
+    if not stored.startswith(_DELTA_PREFIX):
+        return json.loads(stored)
+    if previous is None:
+        raise ValueError("разница состояния без предшествующего снимка")
+    delta = json.loads(stored[len(_DELTA_PREFIX):])
+    state = {**previous, **delta}
+    for key in delta.get(_REMOVED, ()):
+        state.pop(key, None)
+    state.pop(_REMOVED, None)
+    return state
+
+
+def iter_session_states(session_id, path=None):
+    """Генератор (action_id, состояние) по всем действиям сессии по порядку"""
+    conn = get_connection(path)
+    cur = conn.execute("SELECT id, result_state FROM player_actions WHERE session_id = ? ORDER BY id",
+                       (session_id,))
+    state = None
+    for action_id, stored in cur:
+        state = decode_state(stored, state)
+        yield action_id, state
+
+
+def load_result_state(action_id, path=None):
+    """Состояние после действия action_id: ближайший снимок и разницы после него"""
+    conn = get_connection(path)
+    row = conn.execute("SELECT session_id FROM player_actions WHERE id = ?", (action_id,)).fetchone()
+    if row is None:
+        return None
+    # Снимок - значение не с префиксом разницы (сжатые снимки хранятся как BLOB)
+    start = conn.execute("""
+        SELECT MAX(id) FROM player_actions
+        WHERE session_id = ? AND id <= ?
+          AND (typeof(result_state) = 'blob' OR substr(result_state, 1, 1) != ?)
+    """, (row[0], action_id, _DELTA_PREFIX)).fetchone()[0]
+    if start is None:
+        return None
+    state = None
+    for (stored,) in conn.execute("""
+        SELECT result_state FROM player_actions
+        WHERE session_id = ? AND id BETWEEN ? AND ? ORDER BY id
+    """, (row[0], start, action_id)):
+        state = decode_state(stored, state)
+    return state
+
+
+_INSERT_ACTION = """
+    INSERT INTO player_actions
+    (session_id, timestamp, player, action_type, card_name, card_power, line_key, result_state, round)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def _action_row(encoder, session_id, player, action_type, card_name, card_power,
+                line_key, game_state, round_num):
+    # Состояние кодируется сразу: словари движка меняются следующим ходом
+    return (session_id,
+            datetime.datetime.now(),
+            player,
+            action_type,
+            card_name,
+            card_power,
+            line_key,
+            encoder.encode(session_id, game_state),
+            round_num)
+
+
+# Прибавляет накопленные счётчики к строке карты; средние пересчитываются
+# из сумм, поэтому остаются точными (в SET справа - старые значения строки)
+_UPSERT_CARD_STATISTICS = """
+    INSERT INTO card_statistics
+    (card_name, times_used, power_sum, ability_activations, avg_power)
+    VALUES (:card_name, :times_used, :power_sum, :ability_activations,
+            CAST(:power_sum AS REAL) / :times_used)
+    ON CONFLICT(card_name) DO UPDATE SET
+        times_used = times_used + excluded.times_used,
+        power_sum = power_sum + excluded.power_sum,
+        ability_activations = ability_activations + excluded.ability_activations,
+        avg_power = CAST(power_sum + excluded.power_sum AS REAL) / (times_used + excluded.times_used)
+"""
+
+# Карты, которые каждый игрок выставлял за партию, с исходом партии для него.
+# Карта, сыгранная обоими игроками, участвует в партии дважды; ничья -
+# участие без победы. Победитель записан именем игрока.
+_FIELDED_CARDS = """
+    SELECT DISTINCT a.session_id, a.card_name, a.player,
+           COALESCE(s.winner_seat = a.player, 0) AS won
+    FROM player_actions a JOIN game_sessions s ON s.id = a.session_id
+    WHERE a.action_type = 'place_card' AND a.card_name IS NOT NULL AND s.winner IS NOT NULL
+"""
+
+# Исход одной партии всем её картам - одним выражением
+_UPSERT_MATCH_OUTCOME = f"""
+    INSERT INTO card_statistics (card_name, matches_played, wins, win_rate)
+    SELECT card_name, COUNT(*), SUM(won), CAST(SUM(won) AS REAL) / COUNT(*)
+    FROM ({_FIELDED_CARDS}) WHERE session_id = ?
+    GROUP BY card_name
+    ON CONFLICT(card_name) DO UPDATE SET
+        matches_played = matches_played + excluded.matches_played,
+        wins = wins + excluded.wins,
+        win_rate = CAST(wins + excluded.wins AS REAL) / (matches_played + excluded.matches_played)
+"""
+
+
+class CardStatistics:
+    """Счётчики карт в памяти между сбросами: использования, сумма силы, способности"""
+    def __init__(self):
+        self.cards = {}
+        self.lock = threading.Lock()
+
+    def add(self, card_name, power, ability_used=False):
+        with self.lock:
+            counters = self.cards.get(card_name)
+            if counters is None:
+                counters = self.cards[card_name] = [0, 0, 0]
+            counters[0] += 1
+            counters[1] += power
+            counters[2] += bool(ability_used)
+
+    def drain(self):
+        """Забирает накопленное в виде строк для _UPSERT_CARD_STATISTICS"""
+        with self.lock:
+            cards, self.cards = self.cards, {}
+        return [{"card_name": card_name, "times_used": times_used, "power_sum": power_sum,
+                 "ability_activations": abilities}
+                for card_name, (times_used, power_sum, abilities) in cards.items()]
+
+
+def recompute_win_rates(path=None):
+    """Пересчитывает участие и победы всех карт заново по логам всех партий"""
+    conn = get_connection(path)
+    with conn:
+        _recompute_win_rates(conn.cursor())
+
+
+def _recompute_win_rates(cur):
+    cur.execute("UPDATE card_statistics SET matches_played = 0, wins = 0, win_rate = 0")
+    cur.execute(f"""
+        INSERT INTO card_statistics (card_name, matches_played, wins, win_rate)
+        SELECT card_name, COUNT(*), SUM(won), CAST(SUM(won) AS REAL) / COUNT(*)
+        FROM ({_FIELDED_CARDS}) WHERE true
+        GROUP BY card_name
+        ON CONFLICT(card_name) DO UPDATE SET
+            matches_played = excluded.matches_played,
+            wins = excluded.wins,
+            win_rate = excluded.win_rate
+    """)
+
+
+class WriteBehind:
+    """
+    Отложенная запись логов и статистики. Стол только ставит записи в
+    очередь, фоновый поток складывает их в одну транзакцию на каждые
+    batch_size записей или flush_interval секунд, поэтому задержка ходов
+    не зависит от скорости диска. Порядок записей сохраняется.
+
+    Статистика карт копится в памяти и уходит в базу одним пакетным
+    UPSERT при flush() (конец раунда и партии) и при close().
+    """
+    def __init__(self, batch_size=64, flush_interval=0.05, path=None):
+        # None - DB_PATH на момент записи
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.encoder = StateEncoder()
+        self.card_statistics = CardStatistics()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @property
+    def depth(self):
+        """Число записей, ещё не отданных в базу"""
+        return self.queue.qsize()
+
+    def log_action(self, session_id, player, action_type, card_name=None, card_power=None,
+                   line_key=None, game_state=None, round_num=1):
+        if session_id is None:
+            return
+        self.queue.put(("action", _action_row(self.encoder, session_id, player, action_type, card_name,
+                                              card_power, line_key, game_state, round_num)))
+
+    def update_card_statistics(self, card_name, power, ability_used=False):
+        self.card_statistics.add(card_name, power, ability_used)
+
+    def start_game_session(self, session_id, start_time, p1, p2):
+        # Действия партии идут в той же очереди следом - строка сессии уже будет в базе
+        self.queue.put(("start", (session_id, start_time, p1, p2)))
+
+    def end_game_session(self, session_id, winner, rounds_played, duration_sec, winner_seat=None):
+        self.encoder.forget(session_id)
+        self.queue.put(("session", (datetime.datetime.now(), winner, winner_seat, rounds_played,
+                                    duration_sec, session_id)))
+        # Идёт следом за записью итога, в той же очереди - логи партии уже в базе
+        self.queue.put(("outcome", (session_id,)))
+
+    def flush(self, wait=True, timeout=None):
+        """Записывает накопленное сразу; wait=True - дождаться commit"""
+        self.queue_card_statistics()
+        done = threading.Event()
+        self.queue.put(done)
+        if wait:
+            return done.wait(timeout)
+        return True
+
+    def close(self, timeout=10):
+        """Дописывает очередь и останавливает поток (при остановке сервера)"""
+        self.queue_card_statistics()
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def queue_card_statistics(self):
+        rows = self.card_statistics.drain()
+        if rows:
+            self.queue.put(("cards", rows))
+
+    def run(self):
+        running = True
+        while running:
+            batch = []
+            done = []
+            item = self.queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is None:
+                    running = False
+                    break
+                if isinstance(item, threading.Event):
+                    done.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self.write(batch)
+            for event in done:
+                event.set()
+
+    def write(self, batch):
+        conn = get_connection(self.path)
+        try:
+            with conn:
+                cur = conn.cursor()
+                for kind, args in batch:
+                    if kind == "action":
+                        cur.execute(_INSERT_ACTION, args)
+                    elif kind == "start":
+                        cur.execute(_START_SESSION, args)
+                    elif kind == "cards":
+                        cur.executemany(_UPSERT_CARD_STATISTICS, args)
+                    elif kind == "outcome":
+                        cur.execute(_UPSERT_MATCH_OUTCOME, args)
+                    else:
+                        cur.execute(_END_SESSION, args)
+        except sqlite3.Error as e:
+            print(f"[DB] Ошибка записи пакета из {len(batch)} записей: {e}")
@@ -0,0 +1,538 @@
+"""
+Движок правил Гамбита.
+
+Вся логика партии без сокетов, print, time.sleep и базы данных:
+GameState хранит состояние стола, а apply(action) переводит его в
+следующее состояние и возвращает список событий. Сервер, боты и тесты
+управляют партией одинаково - через apply().
+"""
+import functools
+import random
+from array import array
+
+from cards import (cards_list, get_card_id, deck_hash, mage_synergy_ability, CARD_FLAGS, IMMUNE,
+                   MAGE_BUFFED, FIRE_MAGE_ID, ICE_MAGE_ID)
+
+LINE_KEYS = ["p1_back", "p1_front", "p2_front", "p2_back"]
+PLAYER_KEYS = ["p1", "p2"]
+
+DECK_SIZE = 20
+START_HAND = 10
+ROUND_HAND = 5
+START_LIVES = 2
+
+# Сколько разных колод помнит кэш проверки
+DECK_CACHE_SIZE = 1024
+
+
+class BoardLine:
+    """
+    Один ряд поля: параллельные массивы id карт, текущей силы и флагов.
+    Владелец ряда задаётся его ключом (p1_*/p2_*), поэтому отдельно
+    для карт не хранится.
+
+    Ряд поддерживает при каждом изменении сумму своих сил (total), очки
+    владельца и индексы поля (Board), а также индексы самой сильной карты
+    без иммунитета и самой слабой карты. Индексы обновляются за O(1) при
+    каждом изменении и пересчитываются просмотром ряда, только когда
+    ослабла или ушла с поля сама крайняя карта. Поэтому карты, их силу
+    и флаги меняют только через методы ряда, а не записью в массивы.
+    """
+    __slots__ = ("card_ids", "powers", "flags", "total", "owner", "board",
+                 "_strongest", "_weakest")
+
+    def __init__(self, owner, board):
+        self.card_ids = array("B")
+        self.powers = array("h")
+        self.flags = array("B")
+        self.total = 0
+        self.owner = owner
+        self.board = board
+        # Позиции крайних карт: None - подходящей карты нет
+        self._strongest = None
+        self._weakest = None
+
+    def __len__(self):
+        return len(self.card_ids)
+
+    def append(self, card_id, power):
+        index = len(self.card_ids)
+        flags = CARD_FLAGS[card_id]
+        self.card_ids.append(card_id)
+        self.powers.append(power)
+        self.flags.append(flags)
+        unbuffed = self.board.unbuffed.get(card_id)
+        if unbuffed is not None:
+            unbuffed.append([self, index])
+        self._shift(power)
+        # Новая карта - последняя, при равной силе крайней остаётся прежняя
+        if not flags & IMMUNE and self._strongest != -1 and (
+                self._strongest is None or power > self.powers[self._strongest]):
+            self._strongest = index
+        if self._weakest != -1 and (self._weakest is None or power < self.powers[self._weakest]):
+            self._weakest = index
+        return index
+
+    def remove(self, index):
+        self.board.forget_position(self, index)
+        self._shift(-self.powers[index])
+        del self.card_ids[index]
+        del self.powers[index]
+        del self.flags[index]
+        self._strongest = self._after_remove(self._strongest, index)
+        self._weakest = self._after_remove(self._weakest, index)
+
+    def add_power(self, index, delta):
+        """Меняет силу карты index на delta"""
+        self.powers[index] += delta
+        self._shift(delta)
+        power = self.powers[index]
+
+        strongest = self._strongest
+        if strongest == index:
+            if delta < 0:
+                self._strongest = -1
+        elif strongest != -1 and not self.flags[index] & IMMUNE and (
+                strongest is None or power > self.powers[strongest]
+                or (power == self.powers[strongest] and index < strongest)):
+            self._strongest = index
+
+        weakest = self._weakest
+        if weakest == index:
+            if delta > 0:
+                self._weakest = -1
+        elif weakest != -1 and (power < self.powers[weakest]
+                                or (power == self.powers[weakest] and index < weakest)):
+            self._weakest = index
+
+    def set_flag(self, index, flag):
+        if self.flags[index] & flag:
+            return
+        self.flags[index] |= flag
+        if flag & MAGE_BUFFED:
+            self.board.forget_position(self, index, shift=False)
+        if flag & IMMUNE and self._strongest == index:
+            self._strongest = -1
+
+    def clear(self):
+        while self.card_ids:
+            self.remove(len(self.card_ids) - 1)
+
+    def strongest_target(self):
+        """Индекс самой сильной карты без иммунитета (первой из равных) или None"""
+        if self._strongest == -1:
+            strongest = None
+            powers = self.powers
+            for i, flags in enumerate(self.flags):
+                if not flags & IMMUNE and (strongest is None or powers[i] > powers[strongest]):
+                    strongest = i
+            self._strongest = strongest
+        return self._strongest
+
+    def weakest(self, exclude=None):
+        """Индекс самой слабой карты (первой из равных), кроме exclude, или None"""
+        if self._weakest == -1:
+            self._weakest = self._find_weakest(None)
+        if self._weakest is not None and self._weakest == exclude:
+            return self._find_weakest(exclude)
+        return self._weakest
+
+    def _find_weakest(self, exclude):
+        weakest = None
+        powers = self.powers
+        for i in range(len(powers)):
+            if i != exclude and (weakest is None or powers[i] < powers[weakest]):
+                weakest = i
+        return weakest
+
+    def _after_remove(self, extreme, index):
+        # -1 - крайняя карта ушла, индекс нужно пересчитать при запросе
+        if extreme is None or extreme == -1:
+            return extreme
+        if extreme == index:
+            return -1 if self.card_ids else None
+        return extreme - 1 if extreme > index else extreme
+
+    def _shift(self, delta):
+        self.total += delta
+        self.board.totals[self.owner] += delta
+
+    def cards(self):
+        """Пары (card_id, power) в порядке выкладки"""
+        return list(zip(self.card_ids, self.powers))
+
+
+class Board:
+    """
+    Игровое поле: четыре ряда BoardLine по ключам LINE_KEYS, очки игроков
+    и индекс unbuffed: позиции [ряд, индекс] магов каждого вида, ещё не
+    получивших бафф синергии.
+    """
+    __slots__ = ("lines", "totals", "unbuffed")
+
+    def __init__(self):
+        self.totals = {player: 0 for player in PLAYER_KEYS}
+        self.unbuffed = {FIRE_MAGE_ID: [], ICE_MAGE_ID: []}
+        self.lines = {key: BoardLine(key[:2], self) for key in LINE_KEYS}
+
+    def __getitem__(self, line_key):
+        return self.lines[line_key]
+
+    def items(self):
+        return self.lines.items()
+
+    def forget_position(self, line, index, shift=True):
+        """
+        Убирает из unbuffed позицию index ряда line (карта баффнута или
+        уходит с поля); shift - карта удаляется, позиции за ней сдвигаются
+        """
+        for positions in self.unbuffed.values():
+            for position in positions:
+                if position[0] is line and position[1] == index:
+                    positions.remove(position)
+                    break
+            if shift:
+                for position in positions:
+                    if position[0] is line and position[1] > index:
+                        position[1] -= 1
+
+    def cards(self):
+        """Все карты на поле: тройки (card_id, power, line_key)"""
+        return [(card_id, power, key) for key, line in self.lines.items()
+                for card_id, power in zip(line.card_ids, line.powers)]
+
+    def line_totals(self):
+        """Сила каждого ряда: {line_key: сумма}"""
+        return {key: line.total for key, line in self.lines.items()}
+
+    def clear(self):
+        for line in self.lines.values():
+            line.clear()
+
+
+class Deck:
+    """Перемешанная колода: id карт и указатель на верхнюю карту"""
+    __slots__ = ("card_ids", "top")
+
+    def __init__(self, card_ids=()):
+        self.card_ids = array("B", card_ids)
+        self.top = 0
+
+    def __len__(self):
+        return len(self.card_ids) - self.top
+
+    def draw(self, count):
+        """Снимает до count карт сверху и возвращает их id"""
+        drawn = self.card_ids[self.top:self.top + count]
+        self.top += len(drawn)
+        return drawn
+
+
+@functools.lru_cache(maxsize=DECK_CACHE_SIZE)
+def validate_deck(deck_names):
+    """
+    Проверяет колоду - кортеж имён карт. Возвращает (кортеж id, None) или
+    (None, событие deck_rejected без player_id). Результат кэшируется, так
+    что повторно присланная колода не разбирается заново.
+    """
+    # 1. Проверяем размер колоды (должно быть строго 20 карт)
+    if len(deck_names) != DECK_SIZE:
+        return None, {"type": "deck_rejected",
+                      "reason": f"deck has {len(deck_names)} cards",
+                      "message": "В колоде должно быть ровно 20 карт!"}
+
+    # 2. Конвертируем имена карт в id
+    deck = []
+    unknown = []
+    for name in deck_names:
+        card_id = get_card_id(name)
+        if card_id is not None:
+            deck.append(card_id)
+        else:
+            unknown.append(name)
+
+    if unknown:
+        return None, {"type": "deck_rejected",
+                      "reason": f"unknown cards {unknown}",
+                      "message": "Ошибка валидации карт!"}
+    return tuple(deck), None
+
+
+class GameState:
+    """
+    Состояние одной партии.
+
+    apply({"action": ..., "player_id": ...}) меняет состояние и возвращает
+    список событий-словарей вида {"type": ..., ...}. Движок не знает о
+    времени: сообщения игрокам приходят событием "message" с длительностью,
+    а пауза перед концом раунда - событием "round_pending", после которого
+    владелец партии сам решает, когда применить {"action": "end_round"}.
+    """
+    def __init__(self, names=("Игрок 1", "Игрок 2"), rng=None):
+        self.names = list(names)
+        self.rng = rng or random.Random()
+
+        self.players = {}
+        self.ready_players = 0
+        self.current_turn = 0
+        self.game_started = False
+        self.lives = {"p1": START_LIVES, "p2": START_LIVES}
+        self.passed = {"p1": False, "p2": False}
+        self.round = 1
+        self.game_over = False
+        self.winner = None
+
+        self.board = Board()
+        # Очки - суммы сил рядов игрока, их ведёт само поле
+        self.score = self.board.totals
+        # Колоды и руки - списки id карт (индексов в cards_list)
+        self.decks = {"p1": Deck(), "p2": Deck()}
+        self.hands = {"p1": [], "p2": []}
+
+    def to_dict(self):
+        """Публичная часть состояния в формате game_state протокола"""
+        return {
+            "players": self.players,
+            "current_turn": self.current_turn,
+            "game_started": self.game_started,
+            "lives": self.lives,
+            "passed": self.passed,
+            "score": self.score,
+            "line_power": self.board.line_totals(),
+            "round": self.round,
+            "game_over": self.game_over,
+            "winner": self.winner,
+        }
+
+    def round_pending(self):
+        """Оба игрока спасовали, раунд ждёт подведения итогов"""
+        return self.passed["p1"] and self.passed["p2"]
+
+    def legal_actions(self, player_id):
+        """Все допустимые ходы игрока (для ботов и симуляций)"""
+        player_key = PLAYER_KEYS[player_id]
+        if (not self.game_started or self.game_over or self.round_pending()
+                or self.current_turn != player_id):
+            return []
+
+        actions = []
+        own_lines = [key for key in LINE_KEYS if key.startswith(player_key)]
+        for card_index, card_id in enumerate(self.hands[player_key]):
+            allowed_lines = cards_list[card_id].allowed_lines
+            for line_key in own_lines:
+                if line_type(line_key) in allowed_lines:
+                    actions.append({"action": "place_card", "player_id": player_id,
+                                    "card_index": card_index, "line_key": line_key})
+        actions.append({"action": "pass_turn", "player_id": player_id})
+        return actions
+
+    def apply(self, action):
+        """Применяет действие и возвращает список событий"""
+        kind = action.get("action")
+        handler = {
+            "ready": self._ready,
+            "place_card": self._place_card,
+            "pass_turn": self._pass_turn,
+            "end_round": self._end_round,
+        }.get(kind)
+        if handler is None:
+            return [{"type": "rejected", "player_id": action.get("player_id"),
+                     "reason": f"unknown action {kind!r}"}]
+        return handler(action)
+
+    # --- Действия ---
+
+    def _ready(self, action):
+        player_id = action["player_id"]
+        player_key = PLAYER_KEYS[player_id]
+        deck_names = action.get("deck_cards", [])
+
+        if self.game_started:
+            return [{"type": "rejected", "player_id": player_id, "reason": "game already started"}]
+
+        if "deck_ids" in action:
+            # Колода из реестра (по хешу) уже проверена при регистрации
+            card_ids, rejection = tuple(action["deck_ids"]), None
+        else:
+            try:
+                card_ids, rejection = validate_deck(tuple(deck_names))
+            except TypeError:
+                # В колоде не строки - кэш не может их даже сравнить
+                card_ids, rejection = None, {"type": "deck_rejected", "reason": "malformed deck",
+                                             "message": "Ошибка валидации карт!"}
+        if rejection is not None:
+            return [{**rejection, "player_id": player_id}]
+
+        # Перемешиваем и сохраняем колоду для этого игрока
+        deck = list(card_ids)
+        self.rng.shuffle(deck)
+        self.decks[player_key] = Deck(deck)
+        events = [{"type": "deck_loaded", "player_id": player_id, "size": len(deck),
+                   "deck_hash": deck_hash(card_ids), "card_ids": card_ids}]
+
+        # Ставим статус "Готов"
+        if not self.players.get(player_key, {}).get("ready"):
+            self.ready_players += 1
+            self.players[player_key] = {"name": self.names[player_id], "ready": True}
+            events.append({"type": "player_ready", "player_id": player_id,
+                           "ready_players": self.ready_players})
+
+            if self.ready_players == 2:
+                events.extend(self._start_game())
+        return events
+
+    def unready(self, player_id):
+        """Игрок покинул лобби до начала партии"""
+        player_key = PLAYER_KEYS[player_id]
+        if not self.game_started and self.players.get(player_key, {}).get("ready"):
+            self.players[player_key]["ready"] = False
+            self.ready_players = max(0, self.ready_players - 1)
+
+    def _place_card(self, action):
+        player_id = action["player_id"]
+        player_key = PLAYER_KEYS[player_id]
+        if (not self.game_started or self.game_over or self.round_pending()
+                or self.current_turn != player_id):
+            return [{"type": "rejected", "player_id": player_id, "reason": "not your turn"}]
+
+        card_index = action["card_index"]
+        line_key = action["line_key"]
+        hand = self.hands[player_key]
+
+        if not (0 <= card_index < len(hand)):
+            return [{"type": "rejected", "player_id": player_id, "reason": "bad card index"}]
+
+        if (line_key not in self.board.lines or not line_key.startswith(player_key)
+                or line_type(line_key) not in cards_list[hand[card_index]].allowed_lines):
+            return [{"type": "placement_rejected", "player_id": player_id,
+                     "message": "Нельзя разместить здесь!"}]
+
+        card_id = hand.pop(card_index)
+        card = cards_list[card_id]
+        index = self.board[line_key].append(card_id, card.power)
+
+        events = []
+        synergy_applied = mage_synergy_ability(self.board, line_key, index)
+
+        if card.ability:
+            try:
+                card.ability(self.board, line_key, index)
+            except Exception as e:
+                events.append({"type": "ability_failed", "card": card.name, "error": str(e)})
+
+        if card.ability or synergy_applied:
+            events.append({"type": "message", "text": f"{card.name} активировал способность!",
+                           "duration": 2})
+
+        # Сообщение идёт раньше card_placed: ход пишется в историю вместе с ним
+        events.append({"type": "card_placed", "player": player_key, "card_id": card_id,
+                       "power": card.power, "line_key": line_key,
+                       "ability_used": bool(card.ability), "synergy": synergy_applied})
+
+        other_player_id = 1 - player_id
+        if not self.passed[PLAYER_KEYS[other_player_id]]:
+            self.current_turn = other_player_id
+        self.passed[player_key] = False
+        return events
+
+    def _pass_turn(self, action):
+        player_id = action["player_id"]
+        player_key = PLAYER_KEYS[player_id]
+        if not self.game_started or self.game_over or self.round_pending():
+            return [{"type": "rejected", "player_id": player_id, "reason": "cannot pass now"}]
+
+        self.passed[player_key] = True
+        events = [{"type": "message", "text": f"Игрок {player_id+1} пасует до конца раунда",
+                   "duration": 2},
+                  {"type": "turn_passed", "player": player_key}]
+
+        # Проверка, спасовали ли оба
+        if self.round_pending():
+            events.append({"type": "round_pending", "round": self.round})
+        else:
+            other_player_id = 1 - player_id
+            # Проверяем, пасовал ли уже другой игрок
+            if not self.passed[PLAYER_KEYS[other_player_id]]:
+                self.current_turn = other_player_id
+        return events
+
+    def _end_round(self, action):
+        if self.game_over or not self.round_pending():
+            return [{"type": "rejected", "player_id": action.get("player_id"),
+                     "reason": "round is not finished"}]
+
+        p1_score = self.score["p1"]
+        p2_score = self.score["p2"]
+
+        if p1_score > p2_score:
+            self.lives["p2"] -= 1
+            round_winner = "Игрок 1"
+        elif p2_score > p1_score:
+            self.lives["p1"] -= 1
+            round_winner = "Игрок 2"
+        else:
+            self.lives["p1"] -= 1
+            self.lives["p2"] -= 1
+            round_winner = "Ничья"
+
+        events = [{"type": "message", "text": f"Раунд {self.round} за {round_winner}", "duration": 3},
+                  {"type": "round_ended", "round": self.round, "winner": round_winner,
+                   "board": self.board.cards()}]
+
+        if self.lives["p1"] <= 0 or self.lives["p2"] <= 0:
+            self.game_over = True
+            if self.lives["p1"] == self.lives["p2"]:
+                self.winner = "Ничья"
+                winner_seat = None
+            else:
+                winner_seat = "p1" if self.lives["p1"] > 0 else "p2"
+                self.winner = "Игрок 1" if winner_seat == "p1" else "Игрок 2"
+            # winner - метка для показа, winner_seat - место победителя для статистики
+            events.append({"type": "game_over", "winner": self.winner, "winner_seat": winner_seat,
+                           "rounds": self.round})
+        else:
+            self.round += 1
+            # Сбрасываем флаги паса только здесь - в начале нового раунда
+            self.passed = {"p1": False, "p2": False}
+
+            # Очистка поля (вместе с флагами баффов)
+            self.board.clear()
+
+            # Выдаем следующие 5 карт из оставшейся колоды
+            events.append({"type": "round_started", "round": self.round})
+            events.extend(self.draw_cards("p1", ROUND_HAND))
+            events.extend(self.draw_cards("p2", ROUND_HAND))
+
+            # Определяем первого ходящего в новом раунде
+            self.current_turn = 0 if self.round % 2 != 0 else 1
+
+        return events
+
+    # --- Внутренние переходы ---
+
+    def _start_game(self):
+        self.game_started = True
+        events = [{"type": "game_started"}]
+        events.extend(self.draw_cards("p1", START_HAND))
+        events.extend(self.draw_cards("p2", START_HAND))
+        return events
+
+    def draw_cards(self, player, count):
+        """
+        Выдает игроку карты из его персональной колоды.
+        Карты удаляются из колоды (не повторяются).
+        Если карт не хватает, выдает все оставшиеся.
+        """
+        drawn = self.decks[player].draw(count)
+        self.hands[player].extend(drawn)
+        events = [{"type": "cards_drawn", "player": player, "count": len(drawn),
+                   "left": len(self.decks[player])}]
+        if len(drawn) < count:
+            events.append({"type": "deck_empty", "player": player})
+            events.append({"type": "message", "text": f"У {player} закончились карты!", "duration": 2})
+        return events
+
+
+def line_type(line_key):
+    """Тип ряда ("front"/"back") по ключу линии"""
+    return "front" if "front" in line_key else "back"
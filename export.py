@@ -0,0 +1,186 @@
+"""
+Потоковая выгрузка player_actions для офлайн-анализа.
+
+Строки читаются курсором порциями через fetchmany() и сразу пишутся в
+файл, поэтому память не зависит от размера истории. Форматы:
+
+    jsonl    одна строка JSON на действие (с --states - и состояние игры)
+    csv      таблица с заголовком
+    columns  каталог с колонками фиксированной ширины, little-endian:
+             session_id.bin (u4), round.bin (u2), card_id.bin (i2, -1 - без карты),
+             power.bin (i2), line.bin (i1, индекс в LINE_KEYS, -1 - без линии)
+             и meta.json с числом строк и типами. Колонку можно открыть
+             как numpy.memmap(path, dtype=meta["columns"][name], mode="r").
+
+    python export.py --format csv --out actions.csv
+    python export.py --format columns --out actions_columns --since-id 100000
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+from array import array
+
+import database
+from cards import get_card_id
+from engine import LINE_KEYS
+
+EXPORT_BATCH_SIZE = 5000
+
+ACTION_COLUMNS = ["id", "session_id", "timestamp", "player", "action_type",
+                  "card_name", "card_power", "line_key", "round"]
+
+# Колонки бинарного формата: имя -> (тип numpy, код array)
+COLUMNAR_FIELDS = {
+    "session_id": ("<u4", "I"),
+    "round": ("<u2", "H"),
+    "card_id": ("<i2", "h"),
+    "power": ("<i2", "h"),
+    "line": ("<i1", "b"),
+}
+
+_LINE_INDEX = {line_key: index for index, line_key in enumerate(LINE_KEYS)}
+
+
+def iter_actions(since_id=0, with_states=False, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Генератор действий (кортежи в порядке ACTION_COLUMNS) с id больше since_id.
+    with_states=True добавляет восстановленное состояние игры последним элементом.
+    """
+    conn = database.get_connection()
+    columns = ", ".join(ACTION_COLUMNS + (["result_state"] if with_states else []))
+    cur = conn.execute(f"SELECT {columns} FROM player_actions WHERE id > ? ORDER BY id", (since_id,))
+    # Последнее состояние каждой сессии: разница применяется к нему.
+    # Только этот словарь растёт с историей - по состоянию на сессию
+    states = {}
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            if with_states:
+                session_id = row[1]
+                try:
+                    state = database.decode_state(row[-1], states.get(session_id))
+                except ValueError:
+                    # Выгрузка начата с середины сессии - до снимка состояние неизвестно
+                    state = None
+                states[session_id] = state
+                yield row[:-1] + (state,)
+            else:
+                yield row
+
+
+def export_jsonl(path, since_id=0, with_states=False):
+    count = 0
+    names = ACTION_COLUMNS + (["state"] if with_states else [])
+    with open(path, "w", encoding="utf-8") as f:
+        for row in iter_actions(since_id, with_states):
+            f.write(json.dumps(dict(zip(names, row)), ensure_ascii=False, default=str))
+            f.write("\n")
+            count += 1
+    return count
+
+
+def export_csv(path, since_id=0):
+    count = 0
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(ACTION_COLUMNS)
+        for row in iter_actions(since_id):
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def export_columns(path, since_id=0, batch_size=EXPORT_BATCH_SIZE):
+    """Пишет колонки порциями по batch_size строк, дописывая в конец файлов"""
+    os.makedirs(path, exist_ok=True)
+    files = {name: open(os.path.join(path, f"{name}.bin"), "wb") for name in COLUMNAR_FIELDS}
+    count = 0
+    try:
+        chunk = {name: array(code) for name, (_, code) in COLUMNAR_FIELDS.items()}
+        for row in iter_actions(since_id, batch_size=batch_size):
+            _, session_id, _, _, _, card_name, card_power, line_key, round_num = row
+            card_id = get_card_id(card_name) if card_name is not None else None
+            chunk["session_id"].append(session_id or 0)
+            chunk["round"].append(round_num or 0)
+            chunk["card_id"].append(-1 if card_id is None else card_id)
+            chunk["power"].append(card_power or 0)
+            chunk["line"].append(_LINE_INDEX.get(line_key, -1))
+            count += 1
+            if len(chunk["session_id"]) >= batch_size:
+                _write_chunk(files, chunk)
+        _write_chunk(files, chunk)
+    finally:
+        for f in files.values():
+            f.close()
+
+    meta = {"count": count,
+            "columns": {name: dtype for name, (dtype, _) in COLUMNAR_FIELDS.items()},
+            "line_keys": LINE_KEYS}
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return count
+
+
+def _write_chunk(files, chunk):
+    for name, values in chunk.items():
+        if sys.byteorder == "big":
+            values.byteswap()
+        values.tofile(files[name])
+        del values[:]
+
+
+def load_columns(path):
+    """
+    Открывает выгрузку export_columns: {колонка: массив}. С NumPy колонки
+    отображаются в память (numpy.memmap), без него читаются в array.
+    """
+    with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    columns = {}
+    for name, dtype in meta["columns"].items():
+        column_path = os.path.join(path, f"{name}.bin")
+        if numpy is not None:
+            columns[name] = (numpy.memmap(column_path, dtype=dtype, mode="r", shape=(meta["count"],))
+                             if meta["count"] else numpy.zeros(0, dtype=dtype))
+        else:
+            values = array(COLUMNAR_FIELDS[name][1])
+            with open(column_path, "rb") as f:
+                values.fromfile(f, meta["count"])
+            if sys.byteorder == "big":
+                values.byteswap()
+            columns[name] = values
+    return columns
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка истории действий из game_data.db")
+    parser.add_argument("--db", help="путь к базе (по умолчанию game_data.db рядом с игрой)")
+    parser.add_argument("--format", choices=["jsonl", "csv", "columns"], default="jsonl")
+    parser.add_argument("--out", required=True, help="файл (jsonl, csv) или каталог (columns)")
+    parser.add_argument("--since-id", type=int, default=0, help="выгрузить действия с id больше этого")
+    parser.add_argument("--states", action="store_true", help="jsonl: добавить состояние игры")
+    args = parser.parse_args()
+
+    if args.db:
+        database.DB_PATH = args.db
+
+    if args.format == "jsonl":
+        count = export_jsonl(args.out, args.since_id, args.states)
+    elif args.format == "csv":
+        count = export_csv(args.out, args.since_id)
+    else:
+        count = export_columns(args.out, args.since_id)
+    print(f"[DB] Выгружено действий: {count} -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,445 @@
+"""
+Протокол обмена между сервером и клиентом.
+
+Кадр - 4 байта длины и тело в одном из кодеков: JSON или бинарный
+(struct-упакованные записи с id карт вместо имён и путей к картинкам).
+
+Полный снимок ("game_update") отправляется при входе в партию и по запросу
+"resync", а после каждого действия стол рассылает только изменения
+("game_delta"). Каждое обновление несёт номер версии; дельта применяется
+только к состоянию с версией base, иначе клиент запрашивает resync.
+"""
+import copy
+import json
+import struct
+
+from cards import cards_list
+
+HEADER = struct.Struct('!I')
+
+# Наибольшая длина тела кадра: заголовок с большей длиной - признак
+# испорченного потока или атаки, такое подключение закрывается
+MAX_FRAME_SIZE = 1 << 20
+
+# Кодеки сервер -> клиент. Сервер перечисляет их в welcome, клиент выбирает
+# свой действием "hello". JSON остаётся запасным и отладочным вариантом.
+CODEC_BINARY = "bin"
+CODEC_JSON = "json"
+CODECS = [CODEC_BINARY, CODEC_JSON]
+
+LINE_KEYS = ["p1_back", "p1_front", "p2_front", "p2_back"]
+PLAYER_KEYS = ["p1", "p2"]
+
+# Сообщения о состоянии, которые умеет упаковывать бинарный кодек
+STATE_MESSAGES = {"game_update": 1, "game_delta": 2}
+STATE_MESSAGE_TYPES = {code: name for name, code in STATE_MESSAGES.items()}
+
+# Порядок полей game_state в бинарном кадре (бит i маски - поле i)
+GAME_STATE_FIELDS = ["players", "current_turn", "game_started", "lives", "passed",
+                     "score", "round", "game_over", "winner", "message", "line_power"]
+
+# JSON-кадр всегда начинается с "{", бинарный - с этого маркера
+BINARY_MARKER = 0xB1
+
+_STATE_HEADER = struct.Struct('<BBIIB')   # маркер, тип, version, base, маска секций
+_U8 = struct.Struct('<B')
+_U16 = struct.Struct('<H')
+_BOOL2 = struct.Struct('<??')
+_INT2 = struct.Struct('<hh')
+_LINE_INTS = struct.Struct(f'<{len(LINE_KEYS)}h')
+_NONE_LEN = 0xFF
+
+_SECTION_STATE = 1
+_SECTION_LINES = 2
+_SECTION_HANDS = 4
+_SECTION_COUNTS = 8
+
+
+def encode_frame(message, codec=CODEC_JSON):
+    """Кодирует сообщение в готовый к отправке кадр: 4 байта длины + тело"""
+    body = None
+    if codec == CODEC_BINARY and message.get("type") in STATE_MESSAGES:
+        try:
+            body = encode_binary(message)
+        except (ValueError, KeyError, struct.error):
+            # Поле, которое бинарный кодек не знает - отправляем как JSON
+            body = None
+    if body is None:
+        body = json.dumps(expand_cards(message)).encode('utf-8')
+    return HEADER.pack(len(body)) + body
+
+
+def decode_body(body):
+    """
+    Декодирует тело кадра любого кодека в сообщение с развёрнутыми картами.
+    body может быть memoryview на буфер приёма - данные читаются без копии.
+    """
+    if len(body) and body[0] == BINARY_MARKER:
+        return expand_cards(decode_binary(body))
+    return json.loads(str(body, 'utf-8'))
+
+
+class FrameReader:
+    """
+    Чтение кадров из блокирующего сокета через один переиспользуемый буфер.
+
+    recv_into пишет прямо в bytearray подключения, заголовок и тело могут
+    приходить любыми кусками, а тело декодируется из memoryview на буфер.
+    Буфер растёт только под кадр, который в него не помещается.
+    """
+    def __init__(self, sock, size=65536):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def read_message(self):
+        """Следующее сообщение или None, если соединение закрыто"""
+        while True:
+            available = self.end - self.start
+            needed = HEADER.size
+            if available >= HEADER.size:
+                (length,) = HEADER.unpack_from(self.buffer, self.start)
+                if length > MAX_FRAME_SIZE:
+                    print(f"[PROTOCOL] Кадр длиной {length} байт больше допустимого, соединение закрывается")
+                    return None
+                needed += length
+                if available >= needed:
+                    body = self.view[self.start + HEADER.size:self.start + needed]
+                    self.start += needed
+                    if self.start == self.end:
+                        self.start = self.end = 0
+                    return decode_body(body)
+
+            if self.start + needed > len(self.buffer):
+                self._make_room(needed)
+
+            received = self.sock.recv_into(self.view[self.end:])
+            if not received:
+                return None
+            self.end += received
+
+    def _make_room(self, needed):
+        """Сдвигает недочитанный хвост в начало буфера или увеличивает буфер"""
+        available = self.end - self.start
+        if needed > len(self.buffer):
+            buffer = bytearray(max(needed, 2 * len(self.buffer)))
+            buffer[:available] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            # Источник и приёмник - один буфер, поэтому хвост копируется через bytes
+            self.buffer[:available] = bytes(self.view[self.start:self.end])
+        self.start = 0
+        self.end = available
+
+
+def card_view(card_id):
+    """Карта в руке в формате протокола"""
+    card = cards_list[card_id]
+    return {"name": card.name,
+            "power": card.power,
+            "allowed_lines": card.allowed_lines,
+            "image_path": card.image_path,
+            "ability": card.ability.__name__ if card.ability else None}
+
+
+def line_view(line_key, cards):
+    """Ряд поля из пар (card_id, power) в формате протокола"""
+    player = line_key[:2]
+    return [{"name": cards_list[card_id].name,
+             "power": power,
+             "image_path": cards_list[card_id].image_path,
+             "player": player} for card_id, power in cards]
+
+
+def seat_view(message, player):
+    """
+    Вид сообщения о состоянии для места player ("p1"/"p2") или для зрителя
+    (player=None): своя рука целиком, от чужих рук - только число карт.
+    Строится из общего сообщения поверхностной копией, остальные части
+    (game_state, ряды) у всех видов общие.
+    """
+    if "hands" not in message:
+        return message
+    view = dict(message)
+    hands = message["hands"]
+    if player in hands:
+        view["hands"] = {player: hands[player]}
+    else:
+        del view["hands"]
+    view["hand_counts"] = {p: len(hand) for p, hand in hands.items()}
+    return view
+
+
+def expand_cards(message):
+    """
+    Внутри сервера карты в сообщениях о состоянии - это id (рука) и пары
+    (card_id, power) (ряд). Возвращает копию сообщения, где они развёрнуты
+    в словари с именем, силой и путём к картинке из локальной таблицы карт.
+    """
+    if "line_cards" not in message and "hands" not in message:
+        return message
+    message = dict(message)
+    if "line_cards" in message:
+        message["line_cards"] = {key: line_view(key, cards)
+                                 for key, cards in message["line_cards"].items()}
+    if "hands" in message:
+        message["hands"] = {player: [card_view(card_id) for card_id in hand]
+                            for player, hand in message["hands"].items()}
+    return message
+
+
+# --- Бинарный кодек ---
+
+def _pack_str(text, length):
+    if text is None:
+        if length is not _U8:
+            raise ValueError("None is only allowed in short strings")
+        return _U8.pack(_NONE_LEN)
+    data = text.encode('utf-8')
+    return length.pack(len(data)) + data
+
+
+def _unpack_str(body, offset, length):
+    (size,) = length.unpack_from(body, offset)
+    offset += length.size
+    if length is _U8 and size == _NONE_LEN:
+        return None, offset
+    return str(body[offset:offset + size], 'utf-8'), offset + size
+
+
+def _encode_game_state(game_state):
+    mask = 0
+    parts = []
+    for bit, field in enumerate(GAME_STATE_FIELDS):
+        if field not in game_state:
+            continue
+        mask |= 1 << bit
+        value = game_state[field]
+        if field == "players":
+            present = 0
+            players = []
+            for i, player in enumerate(PLAYER_KEYS):
+                if player in value:
+                    present |= 1 << i
+                    players.append(_pack_str(value[player]["name"], _U8)
+                                   + _U8.pack(bool(value[player]["ready"])))
+            parts.append(_U8.pack(present) + b"".join(players))
+        elif field in ("current_turn", "round"):
+            parts.append(_U8.pack(value))
+        elif field in ("game_started", "game_over"):
+            parts.append(_U8.pack(bool(value)))
+        elif field in ("lives", "score"):
+            parts.append(_INT2.pack(value["p1"], value["p2"]))
+        elif field == "passed":
+            parts.append(_BOOL2.pack(value["p1"], value["p2"]))
+        elif field == "winner":
+            parts.append(_pack_str(value, _U8))
+        elif field == "message":
+            parts.append(_pack_str(value, _U16))
+        elif field == "line_power":
+            parts.append(_LINE_INTS.pack(*(value[key] for key in LINE_KEYS)))
+    if len(game_state) != bin(mask).count("1"):
+        raise ValueError(f"unknown game_state fields: {set(game_state) - set(GAME_STATE_FIELDS)}")
+    return _U16.pack(mask) + b"".join(parts)
+
+
+def _decode_game_state(body, offset):
+    (mask,) = _U16.unpack_from(body, offset)
+    offset += _U16.size
+    game_state = {}
+    for bit, field in enumerate(GAME_STATE_FIELDS):
+        if not mask & (1 << bit):
+            continue
+        if field == "players":
+            (present,) = _U8.unpack_from(body, offset)
+            offset += 1
+            players = {}
+            for i, player in enumerate(PLAYER_KEYS):
+                if present & (1 << i):
+                    name, offset = _unpack_str(body, offset, _U8)
+                    players[player] = {"name": name, "ready": bool(body[offset])}
+                    offset += 1
+            value = players
+        elif field in ("current_turn", "round"):
+            value = body[offset]
+            offset += 1
+        elif field in ("game_started", "game_over"):
+            value = bool(body[offset])
+            offset += 1
+        elif field in ("lives", "score"):
+            p1, p2 = _INT2.unpack_from(body, offset)
+            offset += _INT2.size
+            value = {"p1": p1, "p2": p2}
+        elif field == "passed":
+            p1, p2 = _BOOL2.unpack_from(body, offset)
+            offset += _BOOL2.size
+            value = {"p1": p1, "p2": p2}
+        elif field == "winner":
+            value, offset = _unpack_str(body, offset, _U8)
+        elif field == "message":
+            value, offset = _unpack_str(body, offset, _U16)
+        else:
+            value = dict(zip(LINE_KEYS, _LINE_INTS.unpack_from(body, offset)))
+            offset += _LINE_INTS.size
+        game_state[field] = value
+    return game_state, offset
+
+
+def encode_binary(message):
+    """
+    Упаковывает game_update/game_delta: заголовок, затем секции game_state
+    (маска полей + поля фиксированного вида), рядов (id карт и сила), рук
+    (только id карт - имена и картинки клиент берёт из своей таблицы) и
+    числа карт в руках.
+    """
+    sections = 0
+    parts = []
+    if "game_state" in message:
+        sections |= _SECTION_STATE
+        parts.append(_encode_game_state(message["game_state"]))
+    if "line_cards" in message:
+        sections |= _SECTION_LINES
+        lines = message["line_cards"]
+        parts.append(_U8.pack(len(lines)))
+        for key, cards in lines.items():
+            n = len(cards)
+            ids = [card_id for card_id, power in cards]
+            powers = [power for card_id, power in cards]
+            parts.append(struct.pack(f'<BB{n}B{n}h', LINE_KEYS.index(key), n, *ids, *powers))
+    if "hands" in message:
+        sections |= _SECTION_HANDS
+        hands = message["hands"]
+        parts.append(_U8.pack(len(hands)))
+        for player, hand in hands.items():
+            parts.append(struct.pack(f'<BB{len(hand)}B', PLAYER_KEYS.index(player), len(hand), *hand))
+    if "hand_counts" in message:
+        sections |= _SECTION_COUNTS
+        counts = message["hand_counts"]
+        parts.append(_U8.pack(len(counts)))
+        for player, count in counts.items():
+            parts.append(struct.pack('<BB', PLAYER_KEYS.index(player), count))
+
+    header = _STATE_HEADER.pack(BINARY_MARKER, STATE_MESSAGES[message["type"]],
+                                message.get("version", 0), message.get("base", 0), sections)
+    return header + b"".join(parts)
+
+
+def decode_binary(body):
+    """Обратная операция к encode_binary: карты остаются в виде id"""
+    marker, kind, version, base, sections = _STATE_HEADER.unpack_from(body, 0)
+    offset = _STATE_HEADER.size
+    message = {"type": STATE_MESSAGE_TYPES[kind], "version": version}
+    if message["type"] == "game_delta":
+        message["base"] = base
+
+    if sections & _SECTION_STATE:
+        message["game_state"], offset = _decode_game_state(body, offset)
+    if sections & _SECTION_LINES:
+        lines = {}
+        count = body[offset]
+        offset += 1
+        for _ in range(count):
+            key, n = body[offset], body[offset + 1]
+            offset += 2
+            ids = struct.unpack_from(f'<{n}B', body, offset)
+            offset += n
+            powers = struct.unpack_from(f'<{n}h', body, offset)
+            offset += 2 * n
+            lines[LINE_KEYS[key]] = list(zip(ids, powers))
+        message["line_cards"] = lines
+    if sections & _SECTION_HANDS:
+        hands = {}
+        count = body[offset]
+        offset += 1
+        for _ in range(count):
+            player, n = body[offset], body[offset + 1]
+            offset += 2
+            hands[PLAYER_KEYS[player]] = list(struct.unpack_from(f'<{n}B', body, offset))
+            offset += n
+        message["hands"] = hands
+    if sections & _SECTION_COUNTS:
+        counts = {}
+        count = body[offset]
+        offset += 1
+        for _ in range(count):
+            counts[PLAYER_KEYS[body[offset]]] = body[offset + 1]
+            offset += 2
+        message["hand_counts"] = counts
+    return message
+
+
+class StateSync:
+    """
+    Версионированная рассылка состояния одного стола.
+
+    Хранит то, что было разослано в последний раз (копии рядов, рук и полей
+    game_state), и строит дельту только из отличающихся частей. Ряды и руки
+    сравниваются как массивы id/сил, поэтому неизменившиеся части не
+    сериализуются вовсе. Карты в сообщениях остаются в виде id - в словари
+    их разворачивает JSON-кодек или сам клиент.
+    """
+    def __init__(self):
+        self.version = 0
+        self.sent_state = None
+        self.sent_lines = {}
+        self.sent_hands = {}
+
+    def snapshot(self, game_state, board, hands):
+        """Полный снимок текущей версии (базовая линия рассылки не меняется)"""
+        return {"type": "game_update",
+                "version": self.version,
+                "game_state": game_state,
+                "line_cards": {key: line.cards() for key, line in board.items()},
+                "hands": {player: list(hand) for player, hand in hands.items()}}
+
+    def update(self, game_state, board, hands):
+        """
+        Следующее сообщение для рассылки всем игрокам: полный снимок, если
+        рассылок ещё не было, иначе дельта. None - если ничего не изменилось.
+        """
+        if self.sent_state is None:
+            self.version += 1
+            self._remember(game_state, board, hands, board.lines, hands)
+            return self.snapshot(game_state, board, hands)
+
+        changed_state = {key: value for key, value in game_state.items()
+                         if self.sent_state.get(key) != value}
+        changed_lines = [key for key, line in board.items()
+                         if self.sent_lines[key] != (line.card_ids, line.powers)]
+        changed_hands = [player for player, hand in hands.items()
+                         if self.sent_hands[player] != hand]
+
+        if not changed_state and not changed_lines and not changed_hands:
+            return None
+
+        self.version += 1
+        delta = {"type": "game_delta", "version": self.version, "base": self.version - 1}
+        if changed_state:
+            delta["game_state"] = changed_state
+        if changed_lines:
+            delta["line_cards"] = {key: board[key].cards() for key in changed_lines}
+        if changed_hands:
+            delta["hands"] = {player: list(hands[player]) for player in changed_hands}
+
+        self._remember(game_state, board, hands, changed_lines, changed_hands)
+        return delta
+
+    def _remember(self, game_state, board, hands, lines, players):
+        self.sent_state = copy.deepcopy(game_state)
+        for key in lines:
+            line = board[key]
+            self.sent_lines[key] = (line.card_ids[:], line.powers[:])
+        for player in players:
+            self.sent_hands[player] = list(hands[player])
+
+
+def apply_delta(game_state, line_cards, hands, hand_counts, delta):
+    """Применяет дельту к локальной копии состояния (на стороне клиента)"""
+    game_state.update(delta.get("game_state", {}))
+    line_cards.update(delta.get("line_cards", {}))
+    hands.update(delta.get("hands", {}))
+    hand_counts.update(delta.get("hand_counts", {}))
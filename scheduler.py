@@ -0,0 +1,130 @@
+"""
+Планировщик таймеров сервера.
+
+Хешированное колесо таймеров: время делится на тики, таймер кладётся в
+слот (номер тика срабатывания по модулю числа слотов). За тик
+просматривается только один слот, поэтому постановка и отмена - O(1),
+а тысячи таймеров разных столов не требуют ни отдельных потоков, ни
+циклов опроса. Колесо крутится, только пока в нём есть таймеры.
+"""
+import asyncio
+import math
+import threading
+import time
+
+
+class TimerHandle:
+    """Поставленный таймер; cancel() отменяет его, если он ещё не сработал"""
+    __slots__ = ("tick", "callback", "args", "cancelled")
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Колесо таймеров без собственного хода времени: advance() прокручивает
+    его до текущего момента и вызывает наступившие таймеры. Подклассы
+    решают, кто и когда вызывает advance().
+    """
+    def __init__(self, tick=0.05, slots=256, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.slots = [[] for _ in range(slots)]
+        self.started = clock()
+        self.current_tick = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def schedule(self, delay, callback, *args):
+        """Вызывает callback(*args) не раньше, чем через delay секунд"""
+        with self.lock:
+            # Тик отсчитывается от реального времени, а не от последнего advance()
+            now_tick = int((self.clock() - self.started) / self.tick)
+            tick = max(now_tick, self.current_tick) + max(1, math.ceil(delay / self.tick))
+            handle = TimerHandle(tick, callback, args)
+            self.slots[tick % len(self.slots)].append(handle)
+            self.pending += 1
+            wake = self.pending == 1
+        if wake:
+            self.wake()
+        return handle
+
+    def advance(self):
+        """Прокручивает колесо до текущего тика и вызывает наступившие таймеры"""
+        target = int((self.clock() - self.started) / self.tick)
+        due = []
+        with self.lock:
+            while self.current_tick < target:
+                self.current_tick += 1
+                slot = self.slots[self.current_tick % len(self.slots)]
+                if not slot:
+                    continue
+                # В слоте лежат и таймеры следующих оборотов колеса
+                ready = [handle for handle in slot if handle.tick <= self.current_tick]
+                if ready:
+                    slot[:] = [handle for handle in slot if handle.tick > self.current_tick]
+                    self.pending -= len(ready)
+                    due.extend(ready)
+                if not self.pending:
+                    # Пустое колесо догоняет время сразу, без прохода по слотам
+                    self.current_tick = target
+        for handle in due:
+            if not handle.cancelled:
+                try:
+                    handle.callback(*handle.args)
+                except Exception as e:
+                    print(f"[SCHEDULER] Ошибка таймера: {e}")
+
+    def wake(self):
+        """Колесо перестало быть пустым - его нужно снова крутить"""
+
+
+class ThreadedTimerWheel(TimerWheel):
+    """Колесо для потокового сервера: один поток на весь сервер"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def wake(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                # Пустое колесо спит до следующего schedule(), а не опрашивается
+                while not self.pending:
+                    self.condition.wait()
+                self.condition.wait(self.tick)
+            self.advance()
+
+
+class AsyncTimerWheel(TimerWheel):
+    """Колесо для asyncio-сервера: один call_later на тик, пока есть таймеры"""
+    def __init__(self, *args, loop=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = loop or asyncio.get_running_loop()
+        self.armed = False
+
+    def wake(self):
+        if not self.armed:
+            self.armed = True
+            self.loop.call_later(self.tick, self.on_tick)
+
+    def on_tick(self):
+        self.advance()
+        if self.pending:
+            self.loop.call_later(self.tick, self.on_tick)
+        else:
+            self.armed = False
@@ -1,417 +1,627 @@
 import socket
 import threading
-import json
-import random
+import queue
+import asyncio
+import argparse
 import time
 import struct
 import datetime
-from cards import cards_list, Card, get_card_by_name
-from database import init_db, insert_game_session, end_game_session, log_action, update_card_statistics
+from cards import cards_list
+from engine import GameState, PLAYER_KEYS
+from protocol import StateSync, FrameReader, encode_frame, decode_body, seat_view, CODECS, CODEC_JSON, MAX_FRAME_SIZE
+from scheduler import ThreadedTimerWheel, AsyncTimerWheel
+from storage import SqliteStorage, STORAGES
 import os
+import sys
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "game_data.db")
 
-class GameServer:
-    def __init__(self, host='localhost', port=5555):
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server.bind(('0.0.0.0', port))
-        self.server.listen(2)
+# Действия клиента, которые передаются движку правил
+CLIENT_ACTIONS = {"ready", "place_card", "pass_turn"}
+
+# Очередь исходящих кадров на подключение и сколько кадров отправлять за раз
+SEND_QUEUE_SIZE = 64
+SEND_BATCH_SIZE = 32
+
+class QueuedConnection:
+    """
+    Общая часть подключений с очередью исходящих кадров.
+
+    send_frame() только кладёт готовый кадр в очередь и никогда не ждёт
+    сеть - очередь разбирает отдельный писатель (поток или задача),
+    отправляя накопившиеся кадры одной записью. Если клиент не успевает
+    читать и очередь переполнилась, из неё выбрасываются только дельты
+    состояния (droppable), а подключение помечается needs_snapshot - стол
+    сразу отправит ему полный снимок. Остальные сообщения не теряются:
+    если очередь забита ими, медленный клиент отключается.
+    """
+    queue_full = queue.Full
+    queue_empty = queue.Empty
+
+    def send_frame(self, frame, droppable=False):
+        if self.closing:
+            return
+        try:
+            self.send_queue.put_nowait((frame, droppable))
+        except self.queue_full:
+            self.shed_backlog()
+            if droppable:
+                # Новая дельта устарела вместе с выброшенными - её заменит снимок
+                self.needs_snapshot = True
+                return
+            self.put_or_abort((frame, droppable))
+
+    def shed_backlog(self):
+        """Выбрасывает из очереди дельты состояния, сохраняя порядок остальных кадров"""
+        kept = []
+        dropped = 0
+        # Писатель не разбирает очередь, пока она перекладывается
+        with self.queue_lock:
+            while True:
+                try:
+                    item = self.send_queue.get_nowait()
+                except self.queue_empty:
+                    break
+                if item is not None and item[1]:
+                    dropped += 1
+                else:
+                    kept.append(item)
+            for item in kept:
+                self.send_queue.put_nowait(item)
+        if dropped:
+            self.dropped_frames += dropped
+            self.needs_snapshot = True
+            print(f"[SERVER] Клиент {self.address} не успевает читать: отброшено дельт {dropped}")
+
+    def put_or_abort(self, item):
+        try:
+            self.send_queue.put_nowait(item)
+        except self.queue_full:
+            print(f"[SERVER] Клиент {self.address} не читает сообщения - отключаем")
+            self.closing = True
+            self.abort()
+
+    def take_batch(self, item):
+        """Забирает из очереди всё, что накопилось за первым кадром"""
+        items = [item]
+        with self.queue_lock:
+            while items[-1] is not None and len(items) < SEND_BATCH_SIZE:
+                try:
+                    items.append(self.send_queue.get_nowait())
+                except self.queue_empty:
+                    break
+        closing = items[-1] is None
+        if closing:
+            items.pop()
+        return [frame for frame, _ in items], closing
+
+    def close(self):
+        """Закрывает подключение после отправки уже поставленных в очередь кадров"""
+        if self.closing:
+            return
+        try:
+            self.send_queue.put_nowait(None)
+        except self.queue_full:
+            self.shed_backlog()
+            self.put_or_abort(None)
+        self.closing = True
+
+
+class SocketConnection(QueuedConnection):
+    """Подключение игрока через обычный блокирующий сокет (потоковый сервер)"""
+    def __init__(self, sock, address=None):
+        self.sock = sock
+        self.address = address
+        self.codec = CODEC_JSON
+        self.reader = FrameReader(sock)
+
+        self.send_queue = queue.Queue(SEND_QUEUE_SIZE)
+        self.dropped_frames = 0
+        self.needs_snapshot = False
+        self.queue_lock = threading.Lock()
+        self.closing = False
+        self.writer_thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer_thread.start()
+
+    def write_loop(self):
+        try:
+            while True:
+                frames, closing = self.take_batch(self.send_queue.get())
+                if frames:
+                    self.sock.sendall(frames[0] if len(frames) == 1 else b"".join(frames))
+                if closing:
+                    break
+        except OSError as e:
+            print(f"[SERVER] Ошибка отправки: {e}")
+        finally:
+            self.sock.close()
 
-        self.clients = []
+    def abort(self):
+        """Рвёт соединение, не дожидаясь очереди: писатель и читатель получат ошибку"""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def receive_message(self):
+        return self.reader.read_message()
+
+
+class StreamConnection(QueuedConnection):
+    """Подключение игрока через asyncio-потоки (многостоловый сервер)"""
+    queue_full = asyncio.QueueFull
+    queue_empty = asyncio.QueueEmpty
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')
+        self.codec = CODEC_JSON
+
+        self.send_queue = asyncio.Queue(SEND_QUEUE_SIZE)
+        self.dropped_frames = 0
+        self.needs_snapshot = False
+        self.queue_lock = threading.Lock()
+        self.closing = False
+        self.writer_task = asyncio.get_running_loop().create_task(self.write_loop())
+
+    async def write_loop(self):
+        try:
+            while True:
+                frames, closing = self.take_batch(await self.send_queue.get())
+                if frames:
+                    self.writer.writelines(frames)
+                    # drain() ждёт только этого клиента, остальные столы работают
+                    await self.writer.drain()
+                if closing:
+                    break
+        except ConnectionError as e:
+            print(f"[SERVER] Ошибка отправки: {e}")
+        finally:
+            self.writer.close()
+
+    def abort(self):
+        self.writer.transport.abort()
+
+    async def receive_message(self):
+        try:
+            raw_msglen = await self.reader.readexactly(4)
+            msglen = struct.unpack('!I', raw_msglen)[0]
+            if msglen > MAX_FRAME_SIZE:
+                print(f"[SERVER] Клиент {self.address} прислал кадр длиной {msglen} байт, отключаем")
+                return None
+            data = await self.reader.readexactly(msglen)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        return decode_body(data)
+
+
+class Match:
+    """
+    Один игровой стол: подключения игроков, сессия в базе и рассылка.
+    Правила партии живут в engine.GameState, стол только применяет к нему
+    действия игроков и выполняет побочные эффекты полученных событий.
+    Транспорт стол не знает - игроки представлены объектами подключений
+    с методами send_frame(frame, droppable) и close(), где frame - уже
+    закодированный кадр вместе с длиной, и атрибутами codec - кодеком,
+    который выбрал клиент, и needs_snapshot - клиент потерял дельты.
+    """
+    def __init__(self, match_id=1, timers=None, turn_time=None, storage=None):
+        self.match_id = match_id
+        # Колесо таймеров и хранилище истории могут быть общими для всех столов
+        self.timers = timers if timers is not None else ThreadedTimerWheel()
+        self.storage = storage if storage is not None else SqliteStorage()
+        # Время на ход в секундах (None - без ограничения)
+        self.turn_time = turn_time
+        self.turn_clock = None
+        self.turn_marker = None
+        # Места за столом: индекс - player_id, None - место свободно
+        self.clients = [None, None]
+        self.spectators = []
         self.names = ["Игрок 1", "Игрок 2"]
-        self.ready_players = 0
 
-        # Инициализация базы данных
-        init_db()
         self.session_id = None
         self.session_start_time = None
 
         # Состояние игры
-        self.game_state = {
-            "players": {},
-            "current_turn": 0,
-            "game_started": False,
-            "lives": {"p1": 2, "p2": 2},
-            "passed": {"p1": False, "p2": False},
-            "score": {"p1": 0, "p2": 0},
-            "round": 1,
-            "game_over": False,
-            "winner": None,
-            "message": "",
-            "message_timer": 0
-        }
-
-        self.line_cards = {key: [] for key in ["p1_back", "p1_front", "p2_front", "p2_back"]}
-
-        self.decks = {"p1": [], "p2": []}
-        self.hands = {"p1": [], "p2": []}
+        self.state = GameState(self.names)
+        self.message = ""
+        self.message_expiry = None
+        self.sync = StateSync()
+
+    @property
+    def game_state(self):
+        """Состояние партии в формате протокола (вместе с сообщением стола)"""
+        return {**self.state.to_dict(), "message": self.message}
+
+    def is_open(self):
+        """Стол ждёт игроков: партия не началась и есть свободное место"""
+        return not self.state.game_started and None in self.clients
+
+    def is_finished(self):
+        """Стол можно освободить: партия окончена или за столом никого нет"""
+        return self.state.game_over or not any(self.clients)
+
+    def join(self, client):
+        """Сажает подключение на первое свободное место и возвращает player_id"""
+        player_id = self.clients.index(None)
+        self.clients[player_id] = client
+        self.send_message(client, {"type": "welcome",
+                                   "player_id": player_id,
+                                   "player_name": self.names[player_id],
+                                   "codecs": CODECS})
+        return player_id
+
+    # --- Почтовый ящик стола ---
+    #
+    # Все изменения стола выполняются одним потребителем по очереди:
+    # сетевые потоки/задачи только декодируют сообщения и кладут их в
+    # ящик через post(), поэтому состояние не нуждается в блокировках.
+
+    def start(self):
+        """Запускает поток-потребитель почтового ящика"""
+        self.mailbox = queue.SimpleQueue()
+        self.mailbox_thread = threading.Thread(target=self.run_mailbox, daemon=True)
+        self.mailbox_thread.start()
+
+    def post(self, handler, *args):
+        """Ставит вызов handler(*args) в очередь стола"""
+        self.mailbox.put((handler, args))
+
+    def stop(self):
+        self.post(None)
+
+    def run_mailbox(self):
+        while True:
+            handler, args = self.mailbox.get()
+            if handler is None:
+                break
+            self.dispatch(handler, args)
 
-        print(f"[SERVER] Сервер запущен на 127.0.0.1:{port}" if host == 'localhost' else f"[SERVER] Сервер запущен на {host}:{port}")
+    def dispatch(self, handler, args):
+        try:
+            handler(*args)
+        except Exception as e:
+            print(f"[SERVER] Ошибка обработки за столом #{self.match_id}: {e}")
+
+    def schedule(self, delay, callback, *args):
+        """Ставит callback(*args) в почтовый ящик стола через delay секунд"""
+        return self.timers.schedule(delay, self.post, callback, *args)
 
     def send_message(self, client, message):
+        self.send_frame(client, encode_frame(message, client.codec))
+
+    def send_frame(self, client, frame, droppable=False):
         try:
-            data = json.dumps(message, default=self.serialize_card).encode('utf-8')
-            client.send(struct.pack('!I', len(data)))
-            client.send(data)
+            client.send_frame(frame, droppable)
         except Exception as e:
             print(f"[SERVER] Ошибка отправки: {e}")
-
-    def serialize_card(self, obj):
-        if isinstance(obj, Card):
-            return {
-                "name": obj.name,
-                "power": obj.power,
-                "allowed_lines": obj.allowed_lines,
-                "image_path": obj.image_path,
-                "ability": obj.ability.__name__ if obj.ability else None
-            }
-        raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
+        if client.needs_snapshot:
+            # Клиент потерял дельты - догоняем его полным снимком текущей версии
+            client.needs_snapshot = False
+            player = PLAYER_KEYS[self.clients.index(client)] if client in self.clients else None
+            self.send_message(client, seat_view(self.get_game_data(), player))
 
     def broadcast(self, message, exclude=None):
+        # Сообщение кодируется один раз на кодек, всем уходят одни и те же байты
+        frames = {}
+        for client in self.recipients(exclude):
+            frame = frames.get(client.codec)
+            if frame is None:
+                frame = frames[client.codec] = encode_frame(message, client.codec)
+            self.send_frame(client, frame)
+
+    def broadcast_state(self, message):
+        """
+        Рассылает сообщение о состоянии: каждому месту - свой вид (своя рука
+        и число карт соперника), зрителям - общий вид без рук. Каждый вид
+        кодируется один раз на кодек.
+        """
+        frames = {}
+        views = {}
+        # Дельту можно выбросить из очереди медленного клиента, снимок - нет
+        droppable = message["type"] == "game_delta"
+        for player_id, client in enumerate(self.clients):
+            if client is not None:
+                self.send_frame(client, self.view_frame(message, PLAYER_KEYS[player_id],
+                                                        client.codec, views, frames), droppable)
+        for client in self.spectators:
+            self.send_frame(client, self.view_frame(message, None, client.codec, views, frames),
+                            droppable)
+
+    def view_frame(self, message, player, codec, views, frames):
+        frame = frames.get((player, codec))
+        if frame is None:
+            view = views.get(player)
+            if view is None:
+                view = views[player] = seat_view(message, player)
+            frame = frames[(player, codec)] = encode_frame(view, codec)
+        return frame
+
+    def recipients(self, exclude=None):
+        """Все подключения стола: занятые места (кроме exclude) и зрители"""
         for i, client in enumerate(self.clients):
-            if exclude != i:
-                self.send_message(client, message)
-
-    def receive_message(self, client):
-        try:
-            raw_msglen = client.recv(4)
-            if not raw_msglen:
-                return None
-            msglen = struct.unpack('!I', raw_msglen)[0]
-            data = b''
-            while len(data) < msglen:
-                packet = client.recv(min(4096, msglen - len(data)))
-                if not packet:
-                    return None
-                data += packet
-            return json.loads(data.decode('utf-8'))
-        except Exception as e:
-            print(f"[SERVER] Ошибка получения: {e}")
-            return None
-        
-    def check_and_apply_mage_synergy(self, newly_placed_card=None):
-        """Проверяет и применяет синергию магов"""
-        all_cards = []
-        for key, cards in self.line_cards.items():
-            all_cards.extend(cards)
-        
-        has_fire_mage = any(card.get("name") == "Огненный маг" for card in all_cards)
-        has_ice_mage = any(card.get("name") == "Ледяной маг" for card in all_cards)
-        
-        if not has_fire_mage or not has_ice_mage:
-            return False
-        
-        fire_mage = None
-        ice_mage = None
-        
-        for card in all_cards:
-            if card.get("name") == "Огненный маг":
-                fire_mage = card
-            elif card.get("name") == "Ледяной маг":
-                ice_mage = card
-        
-        if not fire_mage or not ice_mage:
-            return False
-        
-        if fire_mage.get("mage_buffed") or ice_mage.get("mage_buffed"):
-            return False
-        
-        fire_mage["power"] += 2
-        ice_mage["power"] += 2
-        fire_mage["mage_buffed"] = True
-        ice_mage["mage_buffed"] = True
-        
-        print(f"[SERVER] Активирована синергия магов: оба получают +2")
-        return True
+            if client is not None and exclude != i:
+                yield client
+        yield from self.spectators
+
+    def add_spectator(self, client):
+        self.spectators.append(client)
+        print(f"[SERVER] Зритель {client.address} за столом #{self.match_id} (зрителей: {len(self.spectators)})")
+        if self.state.game_started:
+            self.send_message(client, seat_view(self.get_game_data(), None))
+
+    def remove_spectator(self, client):
+        if client in self.spectators:
+            self.spectators.remove(client)
+            client.close()
 
-    def handle_client(self, client, player_id):
-        while True:
-            try:
-                message = self.receive_message(client)
-                if message is None:
-                    break
-                self.handle_game_action(message, player_id)
-            except Exception as e:
-                print(f"[SERVER] Ошибка клиента {player_id}: {e}")
-                break
-        self.disconnect_client(client, player_id)
+    def handle_spectator_action(self, data, client):
+        action = data.get("action")
+        if action == "hello" and data.get("codec") in CODECS:
+            client.codec = data["codec"]
+        elif action == "resync":
+            self.send_message(client, seat_view(self.get_game_data(), None))
 
     def disconnect_client(self, client, player_id):
-        if client in self.clients:
-            self.clients.remove(client)
+        if self.leave_seat(client, player_id):
             client.close()
+
+    def leave_seat(self, client, player_id):
+        """Освобождает место игрока, не закрывая подключение"""
+        if self.clients[player_id] is client:
+            self.clients[player_id] = None
             print(f"[SERVER] Игрок {player_id+1} отключился")
 
-            if not self.game_state["game_started"]:
-                player_key = f"p{player_id+1}"
-                if player_key in self.game_state["players"]:
-                    self.game_state["players"][player_key]["ready"] = False
-                    self.ready_players = max(0, self.ready_players - 1)
-            
-            if len(self.clients) > 0:
+            self.state.unready(player_id)
+
+            if any(self.clients):
                 self.broadcast({"type": "player_disconnected", "player": player_id+1})
+            return True
+        return False
 
     def handle_game_action(self, data, player_id):
         action = data.get("action")
-        player_key = f"p{player_id+1}"
-
-        if action == "ready":
-            # ЛОГИКА ЗАГРУЗКИ КОЛОДЫ
-            deck_names = data.get("deck_cards", [])
-            
-            # 1. Проверяем размер колоды (должно быть строго 20 карт)
-            if len(deck_names) != 20:
-                print(f"[SERVER] Игрок {player_id+1} прислал некорректную колоду ({len(deck_names)} карт). Требуется ровно 20 карт.")
-                self.send_message(self.clients[player_id], {
-                    "type": "game_update",
-                    "game_state": {**self.game_state, "message": "В колоде должно быть ровно 20 карт!", "message_timer": time.time() + 4}
-                })
-                return
-
-            # 2. Конвертируем имена карт в объекты
-            player_deck_objects = []
-            for name in deck_names:
-                card_obj = get_card_by_name(name)
-                if card_obj:
-                    player_deck_objects.append(card_obj)
-                else:
-                    print(f"[SERVER] Неизвестная карта '{name}' в колоде игрока {player_id+1}")
-            
-            # Проверяем, что после конвертации осталось ровно 20 карт
-            if len(player_deck_objects) != 20:
-                 self.send_message(self.clients[player_id], {
-                    "type": "game_update",
-                    "game_state": {**self.game_state, "message": "Ошибка валидации карт!", "message_timer": time.time() + 4}
-                })
-                 return
-
-            # 3. Перемешиваем и сохраняем колоду для этого игрока
-            random.shuffle(player_deck_objects)
-            self.decks[player_key] = player_deck_objects
-            print(f"[SERVER] Колода игрока {player_id+1} загружена: {len(self.decks[player_key])} карт")
-
-            # Ставим статус "Готов"
-            if not self.game_state["players"].get(player_key, {}).get("ready"):
-                self.ready_players += 1
-                self.game_state["players"][player_key] = {"name": self.names[player_id], "ready": True}
-                self.broadcast({"type": "player_ready", "player": player_id+1, "ready_players": self.ready_players})
-                
-                if self.ready_players == 2 and not self.game_state["game_started"]:
-                    self.start_game()
-
-        elif action == "place_card":
-            if self.game_state["current_turn"] != player_id:
-                return
-            card_index = data["card_index"]
-            line_key = data["line_key"]
-
-            if card_index < len(self.hands[player_key]):
-                card_obj = self.hands[player_key][card_index]
-                line_type = "front" if "front" in line_key else "back"
-
-                if line_type in card_obj.allowed_lines:
-                    placed_card = self.hands[player_key].pop(card_index)
-                    card_data = {
-                        "data": placed_card,
-                        "name": placed_card.name,
-                        "power": placed_card.power,
-                        "ability": placed_card.ability.__name__ if placed_card.ability else None,
-                        "image_path": placed_card.image_path,
-                        "player": player_key,
-                        "placed": True
-                    }
-                    self.line_cards[line_key].append(card_data)
-
-                    synergy_applied = self.check_and_apply_mage_synergy(card_data)
-                    
-                    if placed_card.ability:
-                        try:
-                            placed_card.ability(self.line_cards, card_data, line_key)
-                        except Exception as e:
-                            print(f"[SERVER] Ошибка при активации способности {placed_card.name}: {e}")
-                    
-                    if placed_card.ability or synergy_applied:
-                        self.show_message(f"{card_data['name']} активировал способность!", 2)
-
-                    self.recalc_scores()
-                    log_action(self.session_id, player_key, "place_card",
-                               placed_card.name, placed_card.power, line_key,
-                               self.game_state, self.game_state["round"])
-
-                    update_card_statistics(placed_card.name, placed_card.power,
-                                           ability_used=bool(placed_card.ability))
-
-                    other_player_id = 1 - player_id
-                    other_player_key = f"p{other_player_id+1}"
-                    if not self.game_state["passed"][other_player_key]:
-                        self.game_state["current_turn"] = other_player_id
-
-                    self.game_state["passed"][player_key] = False
-                    self.update_all_clients()
-                else:
-                    self.show_message("Нельзя разместить здесь!", 2)
-                    self.update_client(player_id)
-
-        elif action == "pass_turn":
-            self.game_state["passed"][player_key] = True
-            self.show_message(f"Игрок {player_id+1} пасует до конца раунда", 2)
-            
-            log_action(self.session_id, player_key, "pass_turn",
-                       None, None, None, self.game_state, self.game_state["round"])
-            
-            # Проверка, спасовали ли оба
-            if self.game_state["passed"]["p1"] and self.game_state["passed"]["p2"]:
-                time.sleep(1)
-                self.end_round()
-            else:
-                other_player_id = 1 - player_id
-                other_player_key = f"p{other_player_id+1}"
-                # Проверяем, пасовал ли уже другой игрок
-                if not self.game_state["passed"][other_player_key]:
-                    self.game_state["current_turn"] = other_player_id
-            
-            self.update_all_clients()
 
-        elif action == "chat_message":
+        if action == "chat_message":
             self.broadcast({
                 "type": "chat_message",
                 "player": player_id+1,
                 "message": data["message"],
                 "player_name": self.names[player_id]
             })
-
-    def show_message(self, text, duration=2):
-        self.game_state["message"] = text
-        self.game_state["message_timer"] = time.time() + duration
-
-    def start_game(self):
-        self.game_state["game_started"] = True
-        self.draw_cards("p1", 10)
-        self.draw_cards("p2", 10)
-        self.session_start_time = time.time()
-        self.session_id = insert_game_session(datetime.datetime.now(),
-                                              self.names[0], self.names[1])
-        print(f"[SERVER] Игра началась! (Сессия #{self.session_id})")
-        self.update_all_clients()
-
-    def draw_cards(self, player, count):
+        elif action == "hello":
+            # Клиент выбирает кодек для сообщений от сервера
+            if data.get("codec") in CODECS:
+                self.clients[player_id].codec = data["codec"]
+        elif action == "resync":
+            self.update_client(player_id)
+        elif action == "ready":
+            self.player_ready(data, player_id)
+        elif action in CLIENT_ACTIONS:
+            events = self.state.apply({**data, "player_id": player_id})
+            self.process_events(events)
+
+    def player_ready(self, data, player_id):
         """
-        Выдает игроку карты из его персональной колоды.
-        Карты удаляются из колоды (не повторяются).
-        Если карт не хватает, выдает все оставшиеся.
+        Готовность с колодой. Клиент сначала присылает только хеш колоды:
+        известная колода берётся из реестра без проверки, на незнакомую
+        сервер отвечает deck_unknown, и клиент присылает список имён.
         """
-        cards_drawn = 0
-        while cards_drawn < count:
-            if len(self.decks[player]) > 0:
-                card_data = self.decks[player].pop(0)
-                self.hands[player].append(card_data)
-                cards_drawn += 1
-            else:
-                print(f"[SERVER] У игрока {player} закончились карты в колоде!")
-                self.show_message(f"У {player} закончились карты!", 2)
-                break
-        
-        print(f"[SERVER] Игрок {player} получил {cards_drawn} карт. Осталось в колоде: {len(self.decks[player])}")
-
-    def recalc_scores(self):
-        self.game_state["score"]["p1"] = 0
-        self.game_state["score"]["p2"] = 0
-        for key, cards in self.line_cards.items():
-            player = "p1" if "p1" in key else "p2"
-            for card in cards:
-                self.game_state["score"][player] += card["power"]
-
-    def end_round(self):
-        p1_score = self.game_state["score"]["p1"]
-        p2_score = self.game_state["score"]["p2"]
-
-        if p1_score > p2_score:
-            self.game_state["lives"]["p2"] -= 1
-            round_winner = "Игрок 1"
-        elif p2_score > p1_score:
-            self.game_state["lives"]["p1"] -= 1
-            round_winner = "Игрок 2"
+        action = {"action": "ready", "player_id": player_id}
+        if "deck_cards" in data:
+            action["deck_cards"] = data["deck_cards"]
         else:
-            self.game_state["lives"]["p1"] -= 1
-            self.game_state["lives"]["p2"] -= 1
-            round_winner = "Ничья"
-
-        self.show_message(f"Раунд {self.game_state['round']} за {round_winner}", 3)
+            deck_hash = data.get("deck_hash")
+            card_ids = self.storage.load_deck(deck_hash) if isinstance(deck_hash, str) else None
+            if card_ids is None:
+                if self.clients[player_id] is not None:
+                    self.send_message(self.clients[player_id], {"type": "deck_unknown", "deck_hash": deck_hash})
+                return
+            action["deck_ids"] = card_ids
+        self.process_events(self.state.apply(action))
 
-        for key, cards in self.line_cards.items():
-            for c in cards:
-                update_card_statistics(c["name"], c["power"], ability_used=bool(c.get("ability")))
+    def end_round(self):
+        self.process_events(self.state.apply({"action": "end_round"}))
+
+    def process_events(self, events):
+        """Выполняет побочные эффекты событий движка: лог, база, сообщения, рассылка"""
+        changed = False
+        for event in events:
+            kind = event["type"]
+
+            if kind == "deck_rejected":
+                player_id = event["player_id"]
+                print(f"[SERVER] Игрок {player_id+1} прислал некорректную колоду: {event['reason']}")
+                if self.clients[player_id] is not None:
+                    game_data = seat_view(self.get_game_data(), PLAYER_KEYS[player_id])
+                    game_data["game_state"] = {**game_data["game_state"], "message": event["message"]}
+                    self.send_message(self.clients[player_id], game_data)
+
+            elif kind == "placement_rejected":
+                self.show_message(event["message"], 2)
+                self.update_client(event["player_id"])
+
+            elif kind == "deck_loaded":
+                print(f"[SERVER] Колода игрока {event['player_id']+1} загружена: {event['size']} карт")
+                if self.storage.save_deck(event["deck_hash"], event["card_ids"]):
+                    print(f"[SERVER] Новая колода в реестре: {event['deck_hash']}")
+
+            elif kind == "player_ready":
+                self.broadcast({"type": "player_ready", "player": event["player_id"]+1,
+                                "ready_players": event["ready_players"]})
+
+            elif kind == "game_started":
+                self.session_start_time = time.time()
+                self.session_id = self.storage.start_session(datetime.datetime.now(),
+                                                             self.names[0], self.names[1])
+                print(f"[SERVER] Игра началась! (Сессия #{self.session_id})")
+                changed = True
+
+            elif kind == "cards_drawn":
+                print(f"[SERVER] Игрок {event['player']} получил {event['count']} карт. Осталось в колоде: {event['left']}")
+
+            elif kind == "deck_empty":
+                print(f"[SERVER] У игрока {event['player']} закончились карты в колоде!")
+
+            elif kind == "message":
+                self.show_message(event["text"], event["duration"])
+
+            elif kind == "ability_failed":
+                print(f"[SERVER] Ошибка при активации способности {event['card']}: {event['error']}")
+
+            elif kind == "card_placed":
+                card = cards_list[event["card_id"]]
+                if event["synergy"]:
+                    print(f"[SERVER] Активирована синергия магов: оба получают +2")
+                self.storage.log_action(self.session_id, event["player"], "place_card",
+                                        card.name, event["power"], event["line_key"],
+                                        self.game_state, self.state.round)
+                self.storage.update_card_statistics(card.name, event["power"],
+                                                    ability_used=event["ability_used"])
+                changed = True
+
+            elif kind == "turn_passed":
+                self.storage.log_action(self.session_id, event["player"], "pass_turn",
+                                        None, None, None, self.game_state, self.state.round)
+                changed = True
+
+            elif kind == "round_pending":
+                self.schedule(1, self.end_round)
+
+            elif kind == "round_ended":
+                for card_id, power, line_key in event["board"]:
+                    card = cards_list[card_id]
+                    self.storage.update_card_statistics(card.name, power, ability_used=bool(card.ability))
+                # Конец раунда - записываем накопленное, не дожидаясь пакета
+                self.storage.flush()
+                changed = True
+
+            elif kind == "round_started":
+                print(f"[SERVER] Начало раунда {event['round']}. Раздача 5 карт.")
+
+            elif kind == "game_over":
+                duration = int(time.time() - self.session_start_time)
+                self.storage.end_session(self.session_id, event["winner"], event["rounds"], duration,
+                                         event["winner_seat"])
+                self.storage.flush()
+                print(f"[SERVER] Игра окончена. Сессия #{self.session_id} сохраняется в базу "
+                      f"(в очереди записи: {self.storage.depth}).")
+
+        if changed:
+            self.update_all_clients()
+            self.arm_turn_clock()
 
-        if self.game_state["lives"]["p1"] <= 0 or self.game_state["lives"]["p2"] <= 0:
-            self.game_state["game_over"] = True
-            if self.game_state["lives"]["p1"] == self.game_state["lives"]["p2"]:
-                self.game_state["winner"] = "Ничья"
-            else:
-                self.game_state["winner"] = "Игрок 1" if self.game_state["lives"]["p1"] > 0 else "Игрок 2"
+    def show_message(self, text, duration=2):
+        """Показывает сообщение стола; сервер сам снимет его через duration секунд"""
+        if self.message_expiry is not None:
+            self.message_expiry.cancel()
+        self.message = text
+        self.message_expiry = self.schedule(duration, self.expire_message, text)
+
+    def expire_message(self, text):
+        # Сообщение могли уже заменить новым - его таймер ещё впереди
+        if self.message != text:
+            return
+        self.message = ""
+        self.message_expiry = None
+        self.update_all_clients()
 
-            duration = int(time.time() - self.session_start_time)
-            end_game_session(self.session_id, self.game_state["winner"],
-                             self.game_state["round"], duration)
-            print(f"[SERVER] Игра окончена. Сессия #{self.session_id} сохранена в базу.")
+    def arm_turn_clock(self):
+        """Перезапускает часы хода, если ход перешёл или на доске что-то изменилось"""
+        if self.turn_time is None:
+            return
+        state = self.state
+        if not state.game_started or state.game_over or state.round_pending():
+            marker = None
         else:
-            self.game_state["round"] += 1
-            # СБРАСЫВАЕМ ФЛАГИ ПАСА ТОЛЬКО ЗДЕСЬ - В НАЧАЛЕ НОВОГО РАУНДА
-            self.game_state["passed"] = {"p1": False, "p2": False}
-            
-            # Очистка поля
-            for key in self.line_cards:
-                # Сбрасываем флаги баффов
-                for card in self.line_cards[key]:
-                    card.pop("mage_buffed", None)
-                self.line_cards[key].clear()
-                
-            # Выдаем следующие 5 случайных карт из оставшейся колоды
-            print(f"[SERVER] Начало раунда {self.game_state['round']}. Раздача 5 карт.")
-            self.draw_cards("p1", 5)
-            self.draw_cards("p2", 5)
-            
-            # Определяем первого ходящего в новом раунде
-            self.game_state["current_turn"] = 0 if self.game_state["round"] % 2 != 0 else 1
-
-        self.recalc_scores()
-        self.update_all_clients()
+            cards_on_board = sum(len(line) for line in state.board.lines.values())
+            marker = (state.round, state.current_turn, cards_on_board,
+                      state.passed["p1"], state.passed["p2"])
+        if marker == self.turn_marker:
+            return
+        self.turn_marker = marker
+        if self.turn_clock is not None:
+            self.turn_clock.cancel()
+            self.turn_clock = None
+        if marker is not None:
+            self.turn_clock = self.schedule(self.turn_time, self.turn_timeout, marker)
+
+    def turn_timeout(self, marker):
+        # Таймер мог сработать одновременно с ходом, который уже в ящике
+        if marker != self.turn_marker:
+            return
+        player_id = self.state.current_turn
+        print(f"[SERVER] Время хода игрока {player_id+1} истекло - автоматический пас")
+        self.turn_marker = None
+        self.turn_clock = None
+        self.process_events(self.state.apply({"action": "pass_turn", "player_id": player_id}))
 
     def update_client(self, player_id):
-        game_data = self.get_game_data()
+        """Полный снимок состояния одному игроку (ответ на resync и ошибки хода)"""
+        if self.clients[player_id] is None:
+            return
+        game_data = seat_view(self.get_game_data(), PLAYER_KEYS[player_id])
         self.send_message(self.clients[player_id], game_data)
 
     def update_all_clients(self):
-        game_data = self.get_game_data()
-        self.broadcast(game_data)
+        """Рассылает всем изменения состояния с прошлой рассылки"""
+        game_data = self.sync.update(self.game_state, self.state.board, self.state.hands)
+        if game_data is not None:
+            self.broadcast_state(game_data)
 
     def get_game_data(self):
-        game_data = {"type": "game_update", "game_state": self.game_state,
-                     "line_cards": {}, "hands": {}}
-        for key, cards in self.line_cards.items():
-            game_data["line_cards"][key] = [{"name": c["name"],
-                                             "power": c["power"],
-                                             "image_path": c["image_path"],
-                                             "player": c["player"]} for c in cards]
-        for player in ["p1", "p2"]:
-            game_data["hands"][player] = [{"name": c.name,
-                                           "power": c.power,
-                                           "allowed_lines": c.allowed_lines,
-                                           "image_path": c.image_path,
-                                           "ability": c.ability.__name__ if c.ability else None} for c in self.hands[player]]
-        return game_data
+        return self.sync.snapshot(self.game_state, self.state.board, self.state.hands)
+
+
+class GameServer(Match):
+    """Классический сервер на один стол: блокирующие сокеты и поток на игрока"""
+    def __init__(self, host='localhost', port=5555, turn_time=None, storage=None):
+        super().__init__(turn_time=turn_time, storage=storage)
+        self.finished = threading.Event()
+        self.game_over_timer = None
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('0.0.0.0', port))
+        self.server.listen(2)
+
+        # Инициализация хранилища истории
+        self.storage.open()
+
+        print(f"[SERVER] Сервер запущен на 127.0.0.1:{port}" if host == 'localhost' else f"[SERVER] Сервер запущен на {host}:{port}")
+
+    def receive_message(self, client):
+        try:
+            return client.receive_message()
+        except Exception as e:
+            print(f"[SERVER] Ошибка получения: {e}")
+            return None
+
+    def handle_client(self, client, player_id):
+        # Поток клиента только читает сообщения и передаёт их в ящик стола
+        while True:
+            message = self.receive_message(client)
+            if message is None:
+                break
+            self.post(self.handle_game_action, message, player_id)
+        self.post(self.disconnect_client, client, player_id)
+
+    def process_events(self, events):
+        super().process_events(events)
+        if self.state.game_over and self.game_over_timer is None:
+            print(f"[SERVER] Победитель: {self.state.winner}")
+            # Даём игрокам посмотреть итог, затем сервер завершается
+            self.game_over_timer = self.timers.schedule(10, self.finished.set)
 
     def run(self):
+        self.start()
         print("[SERVER] Ожидание подключений...")
-        while len(self.clients) < 2:
+        while None in self.clients:
             try:
-                client, address = self.server.accept()
+                sock, address = self.server.accept()
                 print(f"[SERVER] Новое подключение: {address}")
-                self.clients.append(client)
-                player_id = len(self.clients) - 1
-                self.send_message(client, {"type": "welcome",
-                                           "player_id": player_id,
-                                           "player_name": self.names[player_id]})
+                client = SocketConnection(sock, address)
+                player_id = self.join(client)
                 thread = threading.Thread(target=self.handle_client, args=(client, player_id))
                 thread.daemon = True
                 thread.start()
@@ -421,17 +631,157 @@ class GameServer:
             except Exception as e:
                 print(f"[SERVER] Ошибка подключения: {e}")
 
+        try:
+            # Главный поток спит до конца партии, а не опрашивает состояние.
+            # Таймаут нужен только для Ctrl+C: на Windows Event.wait() без
+            # таймаута не прерывается KeyboardInterrupt до самого события
+            if sys.platform == "win32":
+                while not self.finished.wait(1):
+                    pass
+            else:
+                self.finished.wait()
+            # Дописываем игрокам последние кадры и закрываем соединения
+            for client in self.clients:
+                if client is not None:
+                    client.close()
+            for client in self.clients:
+                if client is not None:
+                    client.writer_thread.join(10)
+        except KeyboardInterrupt:
+            print("\n[SERVER] Сервер остановлен")
+        finally:
+            self.storage.close()
+
+
+class AsyncMatch(Match):
+    """
+    Стол многостолового сервера: почтовый ящик разбирает задача в цикле
+    событий, задержки не блокируют цикл. on_finished вызывается после
+    каждого сообщения, пока стол считается завершённым.
+    """
+    def __init__(self, match_id=1, on_finished=None, timers=None, turn_time=None, storage=None):
+        super().__init__(match_id, timers, turn_time, storage)
+        self.on_finished = on_finished
+
+    def start(self):
+        self.mailbox = asyncio.Queue()
+        self.mailbox_task = asyncio.get_running_loop().create_task(self.run_mailbox())
+
+    def post(self, handler, *args):
+        self.mailbox.put_nowait((handler, args))
+
+    async def run_mailbox(self):
+        while True:
+            handler, args = await self.mailbox.get()
+            if handler is None:
+                break
+            self.dispatch(handler, args)
+            if self.is_finished() and self.on_finished is not None:
+                self.on_finished(self)
+            # За столом никого не осталось - потребитель больше не нужен
+            if not any(self.clients) and not self.spectators:
+                break
+
+
+class AsyncGameServer:
+    """
+    Многостоловый сервер на asyncio: все партии живут в одном цикле событий.
+    Новые подключения садятся за первый открытый стол, завершённые столы
+    освобождаются без перезапуска процесса.
+    """
+    def __init__(self, host='0.0.0.0', port=5555, turn_time=None, storage=None):
+        self.host = host
+        self.port = port
+        self.turn_time = turn_time
+        # Одно колесо таймеров на все столы; создаётся в цикле событий
+        self.timers = None
+        self.storage = storage if storage is not None else SqliteStorage()
+        self.matches = {}
+        self.next_match_id = 1
+
+        # Инициализация хранилища истории
+        self.storage.open()
+
+    def find_open_match(self):
+        for match in self.matches.values():
+            if match.is_open():
+                return match
+        match = AsyncMatch(self.next_match_id, on_finished=self.release_match,
+                           timers=self.timers, turn_time=self.turn_time, storage=self.storage)
+        match.start()
+        self.matches[match.match_id] = match
+        self.next_match_id += 1
+        print(f"[SERVER] Открыт стол #{match.match_id} (всего столов: {len(self.matches)})")
+        return match
+
+    def release_match(self, match):
+        if match.is_finished() and self.matches.pop(match.match_id, None) is not None:
+            if match.session_id is not None and not match.state.game_over:
+                # Партия брошена и уже не завершится - хранилище может забыть её состояние
+                self.storage.forget(match.session_id)
+            print(f"[SERVER] Стол #{match.match_id} освобождён (всего столов: {len(self.matches)})")
+
+    async def handle_connection(self, reader, writer):
+        client = StreamConnection(reader, writer)
+        match = self.find_open_match()
+        player_id = match.join(client)
+        print(f"[SERVER] Новое подключение: {client.address} -> стол #{match.match_id}, место {player_id+1}")
+        # Задача подключения только читает сообщения и передаёт их в ящик стола
         try:
             while True:
-                if self.game_state["game_over"]:
-                    print(f"[SERVER] Победитель: {self.game_state['winner']}")
-                    time.sleep(10)
+                message = await client.receive_message()
+                if message is None:
                     break
-                time.sleep(1)
+                if player_id is None:
+                    match.post(match.handle_spectator_action, message, client)
+                elif message.get("action") == "spectate":
+                    # Пересаживаем подключение со своего места в зрители другого стола
+                    target = self.matches.get(message.get("match_id"))
+                    if target is not None and target is not match and not match.state.game_started:
+                        match.post(match.leave_seat, client, player_id)
+                        match, player_id = target, None
+                        match.post(match.add_spectator, client)
+                else:
+                    match.post(match.handle_game_action, message, player_id)
+        except Exception as e:
+            print(f"[SERVER] Ошибка клиента {player_id} за столом #{match.match_id}: {e}")
+        finally:
+            if player_id is None:
+                match.post(match.remove_spectator, client)
+            else:
+                match.post(match.disconnect_client, client, player_id)
+
+    async def serve(self):
+        self.timers = AsyncTimerWheel()
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        print(f"[SERVER] Многостоловый сервер запущен на {self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
         except KeyboardInterrupt:
             print("\n[SERVER] Сервер остановлен")
+        finally:
+            self.storage.close()
 
 
 if __name__ == "__main__":
-    server = GameServer()
-    server.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Сервер игры Гамбит")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--multi", action="store_true",
+                        help="многостоловый asyncio-сервер вместо сервера на одну партию")
+    parser.add_argument("--turn-time", type=float, default=None,
+                        help="время на ход в секундах, по истечении - автоматический пас")
+    parser.add_argument("--storage", choices=sorted(STORAGES), default="sqlite",
+                        help="где хранить историю партий (memory/none - для тестов и ботов)")
+    parser.add_argument("--db", default=None, help="файл базы для --storage sqlite")
+    args = parser.parse_args()
+
+    storage = SqliteStorage(args.db) if args.storage == "sqlite" else STORAGES[args.storage]()
+    if args.multi:
+        server = AsyncGameServer(port=args.port, turn_time=args.turn_time, storage=storage)
+    else:
+        server = GameServer(port=args.port, turn_time=args.turn_time, storage=storage)
+    server.run()
@@ -0,0 +1,201 @@
+"""
+Хранилища истории партий для сервера.
+
+Стол пишет историю только через объект хранилища, который выбирается
+для каждого сервера отдельно:
+
+    SqliteStorage   game_data.db (или другой файл) через очередь отложенной записи
+    MemoryStorage   всё в памяти процесса - для тестов, ботов и нагрузочных прогонов
+    NullStorage     ничего не хранит
+
+Все хранилища понимают одни и те же вызовы; NullStorage - их общая
+основа, остальные переопределяют нужное. Реестр проверенных колод
+(хеш -> id карт) каждое хранилище держит в памяти, SqliteStorage ещё и
+сохраняет его в базе.
+"""
+import datetime
+import json
+
+import database
+
+
+class NullStorage:
+    """Хранилище, которое ничего не сохраняет: партии играются без следа"""
+    def __init__(self):
+        self.last_session_id = 0
+        self.decks = {}
+
+    @property
+    def depth(self):
+        """Число записей, ещё не отданных хранилищу"""
+        return 0
+
+    def open(self):
+        """Готовит хранилище к работе (при запуске сервера)"""
+
+    def close(self):
+        """Дописывает накопленное и освобождает ресурсы (при остановке сервера)"""
+
+    def start_session(self, start_time, p1, p2):
+        self.last_session_id += 1
+        return self.last_session_id
+
+    def end_session(self, session_id, winner, rounds_played, duration_sec, winner_seat=None):
+        """winner - метка победителя для показа, winner_seat - его место (p1/p2, None - ничья)"""
+
+    def log_action(self, session_id, player, action_type, card_name=None, card_power=None,
+                   line_key=None, game_state=None, round_num=1):
+        pass
+
+    def update_card_statistics(self, card_name, power, ability_used=False):
+        pass
+
+    def flush(self, wait=False):
+        """Отдаёт накопленное (конец раунда и партии)"""
+
+    def forget(self, session_id):
+        """Партия брошена без итога - её промежуточное состояние больше не нужно"""
+
+    def load_deck(self, deck_hash):
+        """id карт колоды по её хешу или None, если колода ещё не встречалась"""
+        return self.decks.get(deck_hash)
+
+    def save_deck(self, deck_hash, card_ids):
+        """Запоминает проверенную колоду; возвращает True, если она новая"""
+        if deck_hash in self.decks:
+            return False
+        self.decks[deck_hash] = tuple(sorted(card_ids))
+        return True
+
+
+class SqliteStorage(NullStorage):
+    """История в SQLite: path - файл базы, None - DB_PATH"""
+    def __init__(self, path=None, batch_size=64, flush_interval=0.05):
+        super().__init__()
+        self.path = path
+        self.writer = database.WriteBehind(batch_size, flush_interval, path)
+
+    @property
+    def depth(self):
+        return self.writer.depth
+
+    def open(self):
+        database.init_db(self.path)
+        self.last_session_id = database.last_session_id(self.path)
+        self.decks.update(database.load_decks(self.path))
+
+    def close(self):
+        self.writer.close()
+        database.close_connections(self.path)
+
+    def start_session(self, start_time, p1, p2):
+        # id выдаётся в памяти, строка пишется через очередь: цикл событий
+        # многостолового сервера не ждёт диск. Базу пишет один сервер
+        session_id = super().start_session(start_time, p1, p2)
+        self.writer.start_game_session(session_id, start_time, p1, p2)
+        return session_id
+
+    def end_session(self, session_id, winner, rounds_played, duration_sec, winner_seat=None):
+        self.writer.end_game_session(session_id, winner, rounds_played, duration_sec, winner_seat)
+
+    def log_action(self, session_id, player, action_type, card_name=None, card_power=None,
+                   line_key=None, game_state=None, round_num=1):
+        self.writer.log_action(session_id, player, action_type, card_name, card_power,
+                               line_key, game_state, round_num)
+
+    def update_card_statistics(self, card_name, power, ability_used=False):
+        self.writer.update_card_statistics(card_name, power, ability_used)
+
+    def flush(self, wait=False):
+        self.writer.flush(wait)
+
+    def forget(self, session_id):
+        self.writer.encoder.forget(session_id)
+
+    def save_deck(self, deck_hash, card_ids):
+        # Новые колоды редки, поэтому пишутся сразу, мимо очереди
+        if not super().save_deck(deck_hash, card_ids):
+            return False
+        database.save_deck(deck_hash, card_ids, self.path)
+        return True
+
+
+class MemoryStorage(NullStorage):
+    """
+    История в памяти с теми же правилами подсчёта, что и в SQLite:
+    статистика карт копится до flush(), исход партии засчитывается всем
+    картам, которые выставляли игроки.
+    """
+    def __init__(self):
+        super().__init__()
+        self.sessions = {}
+        self.actions = []
+        self.card_statistics = {}
+        self.pending = database.CardStatistics()
+        # session_id -> {(игрок, карта)} - выставленные за партию карты
+        self.fielded = {}
+
+    @property
+    def depth(self):
+        return len(self.pending.cards)
+
+    def start_session(self, start_time, p1, p2):
+        session_id = super().start_session(start_time, p1, p2)
+        self.sessions[session_id] = {"start_time": start_time, "end_time": None,
+                                     "player1_name": p1, "player2_name": p2, "winner": None, "winner_seat": None,
+                                     "duration_sec": None, "rounds_played": None}
+        self.fielded[session_id] = set()
+        return session_id
+
+    def end_session(self, session_id, winner, rounds_played, duration_sec, winner_seat=None):
+        session = self.sessions[session_id]
+        session.update(end_time=datetime.datetime.now(), winner=winner, winner_seat=winner_seat,
+                       rounds_played=rounds_played, duration_sec=duration_sec)
+        for player, card_name in self.fielded.pop(session_id, ()):
+            stats = self._card(card_name)
+            stats["matches_played"] += 1
+            stats["wins"] += player == winner_seat
+            stats["win_rate"] = stats["wins"] / stats["matches_played"]
+
+    def log_action(self, session_id, player, action_type, card_name=None, card_power=None,
+                   line_key=None, game_state=None, round_num=1):
+        if session_id is None:
+            return
+        # Состояние сохраняется строкой: словари движка меняются следующим ходом
+        self.actions.append({"id": len(self.actions) + 1, "session_id": session_id,
+                             "timestamp": datetime.datetime.now(), "player": player,
+                             "action_type": action_type, "card_name": card_name,
+                             "card_power": card_power, "line_key": line_key,
+                             "result_state": json.dumps(game_state, ensure_ascii=False),
+                             "round": round_num})
+        if action_type == "place_card" and card_name is not None and session_id in self.fielded:
+            self.fielded[session_id].add((player, card_name))
+
+    def update_card_statistics(self, card_name, power, ability_used=False):
+        self.pending.add(card_name, power, ability_used)
+
+    def flush(self, wait=False):
+        for row in self.pending.drain():
+            stats = self._card(row["card_name"])
+            stats["times_used"] += row["times_used"]
+            stats["power_sum"] += row["power_sum"]
+            stats["ability_activations"] += row["ability_activations"]
+            stats["avg_power"] = stats["power_sum"] / stats["times_used"]
+
+    def forget(self, session_id):
+        self.fielded.pop(session_id, None)
+
+    def close(self):
+        self.flush()
+
+    def _card(self, card_name):
+        stats = self.card_statistics.get(card_name)
+        if stats is None:
+            stats = self.card_statistics[card_name] = {
+                "times_used": 0, "power_sum": 0, "avg_power": 0, "ability_activations": 0,
+                "matches_played": 0, "wins": 0, "win_rate": 0}
+        return stats
+
+
+# Имена хранилищ для командной строки сервера
+STORAGES = {"sqlite": SqliteStorage, "memory": MemoryStorage, "none": NullStorage}
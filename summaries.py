@@ -0,0 +1,245 @@
+"""
+Сводные таблицы для дашбордов поверх game_data.db.
+
+Вместо пересчёта всей истории при каждом чтении сводки хранятся в
+отдельных таблицах и обновляются инкрементально: refresh() обрабатывает
+только действия с id больше сохранённой отметки (high-water mark).
+
+    summary_daily        партии по дням: количество, завершённые,
+                         средняя длительность и число раундов
+    summary_winners      распределение победителей по дням
+    summary_card_lines   выставления каждой карты на каждую линию
+
+Сводка по дню пересчитывается целиком, если в этот день были новые
+действия или новые партии либо завершилась партия, открытая при прошлом
+обновлении - её итог появляется без нового действия. Открытые партии
+отслеживаются по id: отметка open_sessions - самая старая незавершённая
+партия не старше OPEN_SESSION_MAX_AGE. Партии старше так и не
+завершённые (обрыв связи, падение сервера) считаются брошенными и больше
+не проверяются. Выставления по линиям только прибавляются.
+
+    python summaries.py              обновить сводки
+    python summaries.py --rebuild    пересобрать с нуля
+    python summaries.py --show       обновить и вывести
+"""
+import argparse
+import datetime
+
+import database
+
+# Сколько ждать итога незавершённой партии, прежде чем считать её брошенной
+OPEN_SESSION_MAX_AGE = datetime.timedelta(hours=6)
+
+
+def init_summaries(cur):
+    """Создаёт сводные таблицы, если их ещё нет"""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS summary_marks (
+        name TEXT PRIMARY KEY,
+        value INTEGER
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS summary_daily (
+        day TEXT PRIMARY KEY,
+        sessions INTEGER,
+        finished INTEGER,
+        open_sessions INTEGER,
+        total_duration INTEGER,
+        total_rounds INTEGER,
+        avg_duration REAL,
+        avg_rounds REAL
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS summary_winners (
+        day TEXT,
+        winner TEXT,
+        sessions INTEGER,
+        PRIMARY KEY (day, winner)
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS summary_card_lines (
+        card_name TEXT,
+        line_key TEXT,
+        placements INTEGER,
+        power_sum INTEGER,
+        PRIMARY KEY (card_name, line_key)
+    )
+    """)
+
+
+def _get_mark(cur, name):
+    row = cur.execute("SELECT value FROM summary_marks WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def _set_mark(cur, name, value):
+    cur.execute("""
+        INSERT INTO summary_marks (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = excluded.value
+    """, (name, value))
+
+
+def _touched_days(cur, last_action_id, last_session_id, open_session_id):
+    days = {day for (day,) in cur.execute("""
+        SELECT DISTINCT date(s.start_time)
+        FROM player_actions a JOIN game_sessions s ON s.id = a.session_id
+        WHERE a.id > ?
+    """, (last_action_id,))}
+    days.update(day for (day,) in cur.execute(
+        "SELECT DISTINCT date(start_time) FROM game_sessions WHERE id > ?", (last_session_id,)))
+    # Уже учтённые партии от самой старой открытой: какие-то из них могли завершиться
+    days.update(day for (day,) in cur.execute("""
+        SELECT DISTINCT date(start_time) FROM game_sessions
+        WHERE id >= ? AND id <= ? AND end_time IS NOT NULL
+    """, (open_session_id, last_session_id)))
+    days.discard(None)
+    return sorted(days)
+
+
+def _oldest_open_session(cur, open_session_id, max_session_id):
+    """Новая отметка open_sessions: самая старая незавершённая и не брошенная партия"""
+    cutoff = datetime.datetime.now() - OPEN_SESSION_MAX_AGE
+    row = cur.execute("""
+        SELECT MIN(id) FROM game_sessions
+        WHERE id >= ? AND end_time IS NULL AND start_time >= ?
+    """, (open_session_id, cutoff)).fetchone()
+    return row[0] if row[0] is not None else max_session_id + 1
+
+
+def _refresh_day(cur, day):
+    # Диапазон по start_time, а не date(start_time) = ?, чтобы работал индекс
+    bounds = (day, day)
+    cur.execute("""
+        INSERT INTO summary_daily
+        (day, sessions, finished, open_sessions, total_duration, total_rounds, avg_duration, avg_rounds)
+        SELECT ?, COUNT(*), COUNT(end_time), COUNT(*) - COUNT(end_time),
+               COALESCE(SUM(duration_sec), 0), COALESCE(SUM(rounds_played), 0),
+               AVG(duration_sec), AVG(rounds_played)
+        FROM game_sessions
+        WHERE start_time >= ? AND start_time < date(?, '+1 day')
+        ON CONFLICT(day) DO UPDATE SET
+            sessions = excluded.sessions,
+            finished = excluded.finished,
+            open_sessions = excluded.open_sessions,
+            total_duration = excluded.total_duration,
+            total_rounds = excluded.total_rounds,
+            avg_duration = excluded.avg_duration,
+            avg_rounds = excluded.avg_rounds
+    """, (day,) + bounds)
+    cur.execute("DELETE FROM summary_winners WHERE day = ?", (day,))
+    cur.execute("""
+        INSERT INTO summary_winners (day, winner, sessions)
+        SELECT ?, winner, COUNT(*)
+        FROM game_sessions
+        WHERE start_time >= ? AND start_time < date(?, '+1 day') AND winner IS NOT NULL
+        GROUP BY winner
+    """, (day,) + bounds)
+
+
+def refresh():
+    """Дописывает в сводки всё, что появилось после прошлого обновления"""
+    conn = database.get_connection()
+    with conn:
+        # Отметки и новые строки читаются в одной транзакции записи
+        conn.execute("BEGIN IMMEDIATE")
+        cur = conn.cursor()
+        init_summaries(cur)
+        last_action_id = _get_mark(cur, "player_actions")
+        last_session_id = _get_mark(cur, "game_sessions")
+        max_action_id = cur.execute("SELECT COALESCE(MAX(id), 0) FROM player_actions").fetchone()[0]
+        max_session_id = cur.execute("SELECT COALESCE(MAX(id), 0) FROM game_sessions").fetchone()[0]
+        open_session_id = _get_mark(cur, "open_sessions")
+
+        days = _touched_days(cur, last_action_id, last_session_id, open_session_id)
+        for day in days:
+            _refresh_day(cur, day)
+
+        cur.execute("""
+            INSERT INTO summary_card_lines (card_name, line_key, placements, power_sum)
+            SELECT card_name, line_key, COUNT(*), COALESCE(SUM(card_power), 0)
+            FROM player_actions
+            WHERE id > ? AND id <= ? AND action_type = 'place_card'
+              AND card_name IS NOT NULL AND line_key IS NOT NULL
+            GROUP BY card_name, line_key
+            ON CONFLICT(card_name, line_key) DO UPDATE SET
+                placements = placements + excluded.placements,
+                power_sum = power_sum + excluded.power_sum
+        """, (last_action_id, max_action_id))
+
+        _set_mark(cur, "player_actions", max_action_id)
+        _set_mark(cur, "game_sessions", max_session_id)
+        _set_mark(cur, "open_sessions", _oldest_open_session(cur, open_session_id, max_session_id))
+    return max_action_id - last_action_id, len(days)
+
+
+def rebuild():
+    """Сбрасывает сводки и отметки и собирает их заново по всей истории"""
+    conn = database.get_connection()
+    with conn:
+        cur = conn.cursor()
+        for table in ("summary_marks", "summary_daily", "summary_winners", "summary_card_lines"):
+            cur.execute(f"DROP TABLE IF EXISTS {table}")
+    return refresh()
+
+
+def daily_sessions():
+    """[(день, партий, завершено, средняя длительность, среднее число раундов)]"""
+    conn = database.get_connection()
+    return conn.execute("""
+        SELECT day, sessions, finished, avg_duration, avg_rounds
+        FROM summary_daily ORDER BY day
+    """).fetchall()
+
+
+def winner_distribution(day=None):
+    """{победитель: партий} за день или за всё время"""
+    conn = database.get_connection()
+    if day is None:
+        rows = conn.execute("SELECT winner, SUM(sessions) FROM summary_winners GROUP BY winner")
+    else:
+        rows = conn.execute("SELECT winner, sessions FROM summary_winners WHERE day = ?", (day,))
+    return dict(rows)
+
+
+def card_line_usage(card_name=None):
+    """{карта: {линия: (выставлений, средняя сила)}}"""
+    conn = database.get_connection()
+    sql = "SELECT card_name, line_key, placements, power_sum FROM summary_card_lines"
+    rows = conn.execute(sql + " WHERE card_name = ?", (card_name,)) if card_name else conn.execute(sql)
+    usage = {}
+    for name, line_key, placements, power_sum in rows:
+        usage.setdefault(name, {})[line_key] = (placements, power_sum / placements)
+    return usage
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обновление сводных таблиц game_data.db")
+    parser.add_argument("--db", help="путь к базе (по умолчанию game_data.db рядом с игрой)")
+    parser.add_argument("--rebuild", action="store_true", help="пересобрать сводки с нуля")
+    parser.add_argument("--show", action="store_true", help="вывести сводки после обновления")
+    args = parser.parse_args()
+
+    if args.db:
+        database.DB_PATH = args.db
+    database.init_db()
+
+    actions, days = rebuild() if args.rebuild else refresh()
+    print(f"[DB] Сводки обновлены: новых действий {actions}, пересчитано дней {days}")
+
+    if args.show:
+        for day, sessions, finished, avg_duration, avg_rounds in daily_sessions():
+            duration = f"{avg_duration:.0f} с" if avg_duration is not None else "-"
+            rounds = f"{avg_rounds:.1f}" if avg_rounds is not None else "-"
+            print(f"{day}  партий: {sessions} (завершено {finished})  длительность: {duration}  раундов: {rounds}")
+        for winner, sessions in sorted(winner_distribution().items()):
+            print(f"Победитель {winner}: {sessions}")
+        for card_name, lines in sorted(card_line_usage().items()):
+            print(f"{card_name:<20} " + "  ".join(f"{line}: {placements} (ср. {power:.1f})"
+                                                for line, (placements, power) in sorted(lines.items())))
+
+
+if __name__ == "__main__":
+    main()
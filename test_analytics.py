@@ -0,0 +1,38 @@
+"""
+Проверка планов аналитических запросов: каждый запрос analytics.py
+должен попадать в индекс, а не просматривать таблицу целиком.
+
+    python -m unittest test_analytics
+"""
+import os
+import tempfile
+import unittest
+
+import analytics
+import database
+
+
+class QueryPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.old_path = database.DB_PATH
+        database.DB_PATH = os.path.join(self.tmpdir.name, "game_data.db")
+        database.init_db()
+
+    def tearDown(self):
+        database.close_connections(database.DB_PATH)
+        database.DB_PATH = self.old_path
+        self.tmpdir.cleanup()
+
+    def test_queries_use_indexes(self):
+        self.assertEqual(analytics.check_query_plans(), [])
+
+    def test_missing_index_is_detected(self):
+        conn = database.get_connection()
+        conn.execute("DROP INDEX idx_actions_session")
+        problems = analytics.check_query_plans()
+        self.assertIn("session_timeline", [name for name, _ in problems])
+
+
+if __name__ == "__main__":
+    unittest.main()
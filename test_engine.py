@@ -0,0 +1,161 @@
+"""
+Проверки движка правил: сыгранные случайными ходами партии с
+фиксированным seed и инварианты поля после каждого действия (суммы
+рядов и очки, индексы крайних карт и не баффнутых магов против
+полного просмотра).
+
+    python -m unittest test_engine
+"""
+import contextlib
+import io
+import json
+import os
+import random
+import unittest
+
+from cards import cards_list, get_card_id, IMMUNE, MAGE_BUFFED, FIRE_MAGE_ID, ICE_MAGE_ID, BANDIT_ID
+from engine import Board, Deck, GameState, PLAYER_KEYS, DECK_SIZE
+
+with open(os.path.join(os.path.dirname(__file__), "my_deck.json"), encoding="utf-8") as f:
+    DECK = json.load(f)["cards"]
+
+GAMES = 60
+
+
+def strongest_target(line):
+    strongest = None
+    for i, flags in enumerate(line.flags):
+        if not flags & IMMUNE and (strongest is None or line.powers[i] > line.powers[strongest]):
+            strongest = i
+    return strongest
+
+
+def weakest(line, exclude=None):
+    result = None
+    for i, power in enumerate(line.powers):
+        if i != exclude and (result is None or power < line.powers[result]):
+            result = i
+    return result
+
+
+def play(seed, check=None):
+    """Партия случайными допустимыми ходами; check(state) - после каждого действия"""
+    rng = random.Random(seed)
+    state = GameState(rng=random.Random(seed))
+    with contextlib.redirect_stdout(io.StringIO()):
+        state.apply({"action": "ready", "player_id": 0, "deck_cards": DECK})
+        state.apply({"action": "ready", "player_id": 1, "deck_cards": DECK})
+        moves = 0
+        while not state.game_over:
+            if state.round_pending():
+                state.apply({"action": "end_round"})
+            else:
+                actions = state.legal_actions(state.current_turn)
+                state.apply(rng.choice(actions) if rng.random() < 0.85 else actions[-1])
+                moves += 1
+            if check is not None:
+                check(state)
+    return state.winner, state.round, moves
+
+
+class BoardInvariantsMixin:
+    def assertBoardConsistent(self, board):
+        for player in PLAYER_KEYS:
+            total = sum(line.total for key, line in board.items() if key.startswith(player))
+            self.assertEqual(board.totals[player], total)
+        for key, line in board.items():
+            self.assertEqual(line.total, sum(line.powers))
+            self.assertEqual(line.strongest_target(), strongest_target(line))
+            for exclude in [None] + list(range(len(line))):
+                self.assertEqual(line.weakest(exclude), weakest(line, exclude))
+        for card_id, positions in board.unbuffed.items():
+            expected = sorted((key, i) for key, line in board.items()
+                              for i, (cid, flags) in enumerate(zip(line.card_ids, line.flags))
+                              if cid == card_id and not flags & MAGE_BUFFED)
+            actual = sorted((line_key(board, line), i) for line, i in positions)
+            self.assertEqual(actual, expected)
+
+
+def line_key(board, line):
+    return next(key for key, other in board.items() if other is line)
+
+
+class SimulatedGamesTest(BoardInvariantsMixin, unittest.TestCase):
+    def test_invariants_hold_after_every_action(self):
+        def check(state):
+            self.assertBoardConsistent(state.board)
+            self.assertEqual(state.score, state.board.totals)
+            self.assertEqual(state.to_dict()["line_power"],
+                             {key: sum(line.powers) for key, line in state.board.items()})
+        for seed in range(GAMES):
+            play(seed, check)
+
+    def test_games_are_reproducible(self):
+        self.assertEqual([play(seed) for seed in range(10)], [play(seed) for seed in range(10)])
+
+    def test_every_game_finishes(self):
+        for seed in range(GAMES):
+            winner, rounds, _ = play(seed)
+            self.assertIn(winner, ("Игрок 1", "Игрок 2", "Ничья"))
+            self.assertLessEqual(rounds, 3)
+
+
+class BoardLineTest(BoardInvariantsMixin, unittest.TestCase):
+    def test_random_operations_match_full_scan(self):
+        rng = random.Random(1)
+        ids = [BANDIT_ID, FIRE_MAGE_ID, ICE_MAGE_ID] + list(range(10))
+        for _ in range(300):
+            board = Board()
+            line = board["p1_back"]
+            for _ in range(30):
+                op = rng.random()
+                if op < 0.4 or not len(line):
+                    line.append(rng.choice(ids), rng.randint(0, 8))
+                elif op < 0.75:
+                    line.add_power(rng.randrange(len(line)), rng.randint(-3, 3))
+                elif op < 0.9:
+                    line.remove(rng.randrange(len(line)))
+                else:
+                    line.set_flag(rng.randrange(len(line)), MAGE_BUFFED)
+                self.assertBoardConsistent(board)
+
+    def test_second_mage_pair_gets_buffed(self):
+        board = Board()
+        fire, ice = cards_list[FIRE_MAGE_ID], cards_list[ICE_MAGE_ID]
+        placed = []
+        for key, card in (("p1_back", fire), ("p2_back", ice), ("p2_back", fire), ("p1_back", ice)):
+            index = board[key].append(card.card_id, card.power)
+            placed.append(card.ability(board, key, index))
+        self.assertEqual(placed, [False, True, False, True])
+        self.assertEqual(board["p1_back"].powers.tolist(), [fire.power + 2, ice.power + 2])
+        self.assertEqual(board["p2_back"].powers.tolist(), [ice.power + 2, fire.power + 2])
+        self.assertBoardConsistent(board)
+
+
+class DeckTest(unittest.TestCase):
+    def test_draw_moves_pointer(self):
+        deck = Deck(range(5))
+        self.assertEqual(deck.draw(3).tolist(), [0, 1, 2])
+        self.assertEqual(deck.draw(3).tolist(), [3, 4])
+        self.assertEqual(len(deck), 0)
+
+    def test_rejected_decks(self):
+        state = GameState()
+        short = state.apply({"action": "ready", "player_id": 0, "deck_cards": DECK[:5]})
+        unknown = state.apply({"action": "ready", "player_id": 0, "deck_cards": ["?"] * DECK_SIZE})
+        malformed = state.apply({"action": "ready", "player_id": 0, "deck_cards": [{}] * DECK_SIZE})
+        for events in (short, unknown, malformed):
+            self.assertEqual(events[0]["type"], "deck_rejected")
+            self.assertEqual(events[0]["player_id"], 0)
+
+    def test_registry_deck_loads_without_names(self):
+        state = GameState()
+        card_ids = [get_card_id(name) for name in DECK]
+        with contextlib.redirect_stdout(io.StringIO()):
+            events = state.apply({"action": "ready", "player_id": 0, "deck_ids": card_ids})
+        self.assertEqual(events[0]["type"], "deck_loaded")
+        self.assertEqual(sorted(state.decks["p1"].card_ids), sorted(card_ids))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+"""
+Проверки протокола: дельты StateSync на стороне клиента дают то же
+состояние, что и полный снимок; оба кодека переживают кодирование и
+декодирование; FrameReader собирает кадры, пришедшие любыми кусками.
+
+    python -m unittest test_protocol
+"""
+import itertools
+import json
+import random
+import unittest
+
+from protocol import (StateSync, FrameReader, apply_delta, decode_body, encode_frame, expand_cards,
+                      seat_view, CODECS, CODEC_BINARY, CODEC_JSON, HEADER, MAX_FRAME_SIZE)
+from test_engine import play
+
+
+def plain(value):
+    """Сообщение в том виде, в каком его видит клиент после JSON (кортежи - списки)"""
+    return json.loads(json.dumps(value))
+
+
+def roundtrip(message, codec):
+    return decode_body(memoryview(encode_frame(message, codec))[HEADER.size:])
+
+
+class ChunkedSocket:
+    """Сокет, который отдаёт заранее заданные байты кусками заданных размеров"""
+    def __init__(self, data, sizes):
+        self.data = data
+        self.sizes = sizes
+        self.offset = 0
+
+    def recv_into(self, view):
+        if self.offset >= len(self.data):
+            return 0
+        size = min(next(self.sizes), len(view), len(self.data) - self.offset)
+        view[:size] = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+
+class Client:
+    """Локальная копия состояния одного места, как у client.GameClient"""
+    def __init__(self):
+        self.state = None
+
+    def receive(self, message):
+        if message["type"] == "game_update":
+            self.state = {key: message.get(key, {}) for key in
+                          ("game_state", "line_cards", "hands", "hand_counts")}
+            self.version = message["version"]
+        else:
+            assert message["base"] == self.version
+            apply_delta(self.state["game_state"], self.state["line_cards"],
+                        self.state["hands"], self.state["hand_counts"], message)
+            self.version = message["version"]
+
+
+class StateSyncTest(unittest.TestCase):
+    def test_deltas_rebuild_full_state_for_every_seat_and_codec(self):
+        for seed in range(15):
+            sync = StateSync()
+            clients = {(player, codec): Client() for player in ("p1", "p2", None) for codec in CODECS}
+
+            def check(state):
+                game_state = {**state.to_dict(), "message": ""}
+                message = sync.update(game_state, state.board, state.hands)
+                snapshot = sync.snapshot(game_state, state.board, state.hands)
+                for (player, codec), client in clients.items():
+                    if message is not None:
+                        client.receive(roundtrip(seat_view(message, player), codec))
+                    expected = expand_cards(seat_view(snapshot, player))
+                    self.assertEqual(plain(client.state),
+                                     plain({key: expected.get(key, {}) for key in client.state}))
+
+            play(seed, check)
+
+
+class CodecTest(unittest.TestCase):
+    def test_state_messages_survive_both_codecs(self):
+        sync = StateSync()
+        messages = []
+
+        def collect(state):
+            message = sync.update({**state.to_dict(), "message": "Раунд 1"}, state.board, state.hands)
+            if message is not None:
+                messages.append(message)
+
+        play(3, collect)
+        for message in messages:
+            for player in ("p1", "p2", None):
+                view = seat_view(message, player)
+                expected = plain(expand_cards(view))
+                for codec in CODECS:
+                    self.assertEqual(plain(roundtrip(view, codec)), expected)
+
+    def test_binary_frames_are_smaller(self):
+        sync = StateSync()
+        states = []
+        play(4, lambda state: states.append(sync.update({**state.to_dict(), "message": ""},
+                                                        state.board, state.hands)))
+        messages = [message for message in states if message is not None]
+        binary = sum(len(encode_frame(seat_view(m, "p1"), CODEC_BINARY)) for m in messages)
+        text = sum(len(encode_frame(seat_view(m, "p1"), CODEC_JSON)) for m in messages)
+        self.assertLess(binary, text)
+
+    def test_other_messages_fall_back_to_json(self):
+        message = {"type": "chat_message", "player": 1, "message": "привет"}
+        self.assertEqual(roundtrip(message, CODEC_BINARY), message)
+
+
+class FrameReaderTest(unittest.TestCase):
+    def test_split_frames(self):
+        rng = random.Random(5)
+        messages = [{"type": "chat_message", "n": i, "text": "ж" * rng.randrange(0, 3000)}
+                    for i in range(200)]
+        data = b"".join(encode_frame(message) for message in messages)
+        for sizes in ([1], [3, 7], [4096], [rng.randrange(1, 9000) for _ in range(64)]):
+            reader = FrameReader(ChunkedSocket(data, itertools.cycle(sizes)), size=64)
+            self.assertEqual([reader.read_message() for _ in messages], messages)
+            self.assertIsNone(reader.read_message())
+
+    def test_oversized_header_closes_without_allocating(self):
+        data = HEADER.pack(MAX_FRAME_SIZE + 1) + b"x"
+        reader = FrameReader(ChunkedSocket(data, itertools.cycle([len(data)])), size=64)
+        self.assertIsNone(reader.read_message())
+        self.assertEqual(len(reader.buffer), 64)
+
+
+if __name__ == "__main__":
+    unittest.main()